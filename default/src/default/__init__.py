@@ -24,9 +24,30 @@ In Proceedings of the 44th International Conference on Software Engineering
 <https://doi.org/10.1145/3510003.3512760>
 """
 
-from default.default import default
+import sys
+
+from default.default import default, merge_stats, shard_stats
 
 
 def main():
-    """Deduplicate execution traces using mutual information."""
-    default()
+    """Deduplicate execution traces using mutual information.
+
+    The subcommand serve runs the triage server instead, the subcommands
+    shard-stats and merge-stats create and merge statistics shards and the
+    subcommand collect collects traces into a statistics shard.
+    """
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "serve":
+        from default.server import serve
+
+        serve(sys.argv[2:])
+    elif command == "collect":
+        from default.collect import collect
+
+        collect(sys.argv[2:])
+    elif command == "shard-stats":
+        shard_stats(sys.argv[2:])
+    elif command == "merge-stats":
+        merge_stats(sys.argv[2:])
+    else:
+        default()
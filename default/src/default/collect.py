@@ -0,0 +1,297 @@
+# Copyright 2025 Fraunhofer AISEC
+# Fraunhofer-Gesellschaft zur Förderung der angewandten Forschung e.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collection of execution traces that are read while they are collected.
+
+The tracer (e.g., Intel Pin with the bbl_tracing tool) is run for every input
+with a bounded number of concurrent jobs and a timeout per job. Like in
+run_pin.sh, jobs that time out are killed together with all of their child
+processes and their traces are removed. Traces are written under a temporary
+name and only renamed once the tracer has finished, so that an interrupted
+collection can be resumed without using partial traces. Each finished trace is
+read by a worker process right away and the result is stored as a statistics
+shard (see default.shards), so that deduplication can start without reading
+the traces again.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from default.default import (
+    build_exclusion_index,
+    parse_exclusion_ranges,
+    read_trace,
+    trace_paths,
+)
+from default.shards import passing_stats, write_shard
+
+# Placeholders in the tracer command for the input and the trace file
+INPUT_PLACEHOLDER = "@@"
+OUTPUT_PLACEHOLDER = "@OUTPUT@"
+
+# Suffix of traces that are still being written
+PARTIAL_SUFFIX = ".partial"
+
+# Exit codes of jobs that are treated as timed out like in run_pin.sh, i.e.,
+# of timeout and of processes killed with SIGKILL (e.g., by the OOM killer)
+TIMEOUT_EXIT_CODES = {124, 128 + signal.SIGKILL, -signal.SIGKILL}
+
+_exclusion_index: tuple[list[int], list[int]] | None = None
+
+
+def _init_worker(exclusion_index: tuple[list[int], list[int]] | None):
+    """Install the exclusion index in a worker process."""
+    global _exclusion_index
+    _exclusion_index = exclusion_index
+
+
+def _read_trace(path: Path) -> dict[str, int]:
+    """Read a single trace in a worker process."""
+    return read_trace(path, _exclusion_index)
+
+
+def tracer_argv(command: list[str], input_path: Path, output_path: Path) -> list[str]:
+    """Insert the input and trace file into the tracer command."""
+    return [
+        arg.replace(OUTPUT_PLACEHOLDER, str(output_path)).replace(
+            INPUT_PLACEHOLDER, str(input_path)
+        )
+        for arg in command
+    ]
+
+
+def collection_jobs(
+    crash_input_dir: Path | None, non_crash_input_dir: Path | None, out_dir: Path
+) -> list[tuple[Path, Path, bool]]:
+    """List the input, trace file and crash flag of every job.
+
+    Traces of crashing inputs keep the directory of their input as parent, since
+    it is the ground-truth label.
+    """
+    jobs = []
+    for input_dir, trace_dir, crashing in [
+        (crash_input_dir, out_dir / "crashing", True),
+        (non_crash_input_dir, out_dir / "non_crashing", False),
+    ]:
+        if input_dir is None:
+            continue
+        for input_path in trace_paths(input_dir):
+            output_path = trace_dir / input_path.relative_to(input_dir.absolute())
+            jobs.append((input_path, output_path, crashing))
+    return jobs
+
+
+def partial_path(output_path: Path) -> Path:
+    """Get the temporary name of a trace while it is written."""
+    return output_path.with_name(output_path.name + PARTIAL_SUFFIX)
+
+
+async def run_tracer(
+    command: list[str], input_path: Path, output_path: Path, timeout: float
+) -> bool:
+    """Run the tracer and remove its trace if it times out.
+
+    The trace is written to its partial_path and renamed to output_path once the
+    tracer has finished. Returns whether the tracer finished in time.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = partial_path(output_path)
+    # A partial trace of an interrupted run is not continued
+    tmp_path.unlink(missing_ok=True)
+
+    # The tracer gets its own process group, so that the traced program and its
+    # children can be killed together with it
+    proc = await asyncio.create_subprocess_exec(
+        *tracer_argv(command, input_path, tmp_path),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        returncode = await asyncio.wait_for(proc.wait(), timeout)
+    except TimeoutError:
+        # Like timeout --signal=9 in run_pin.sh, which kills the process group
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        returncode = 128 + signal.SIGKILL
+
+    if returncode in TIMEOUT_EXIT_CODES:
+        logging.info(f"Command timed out - removing trace {output_path}")
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+    if tmp_path.is_file():
+        tmp_path.replace(output_path)
+    return True
+
+
+async def collect_traces(
+    jobs: list[tuple[Path, Path, bool]],
+    command: list[str],
+    num_jobs: int,
+    timeout: float,
+    pool: ProcessPoolExecutor,
+    num_readers: int,
+) -> tuple[dict[Path, dict[str, int]], dict[Path, dict[str, int]]]:
+    """Trace all inputs and read each trace as soon as it is finished.
+
+    num_jobs tracer tasks take the jobs from a queue and pass finished traces
+    to num_readers tasks that read them in the process pool.
+    """
+    loop = asyncio.get_running_loop()
+    job_queue: asyncio.Queue[tuple[Path, Path, bool]] = asyncio.Queue()
+    for job in jobs:
+        job_queue.put_nowait(job)
+    read_queue: asyncio.Queue[tuple[Path, bool] | None] = asyncio.Queue()
+    Bf_dict: dict[Path, dict[str, int]] = {}
+    Bp_dict: dict[Path, dict[str, int]] = {}
+    progress = tqdm(total=len(jobs))
+
+    async def tracer():
+        while not job_queue.empty():
+            input_path, output_path, crashing = job_queue.get_nowait()
+            # Traces are only renamed to output_path once they are finished, so
+            # existing traces of an earlier run are only read
+            if not output_path.is_file():
+                if not await run_tracer(command, input_path, output_path, timeout):
+                    progress.update()
+                    continue
+                if not output_path.is_file():
+                    logging.warning(f"Tracer did not write a trace for {input_path}")
+                    progress.update()
+                    continue
+            await read_queue.put((output_path, crashing))
+
+    async def reader():
+        while (item := await read_queue.get()) is not None:
+            output_path, crashing = item
+            trace = await loop.run_in_executor(pool, _read_trace, output_path)
+            # Like in preprocess_traces, traces without addresses are skipped
+            if trace:
+                (Bf_dict if crashing else Bp_dict)[output_path] = trace
+            progress.update()
+
+    readers = [asyncio.create_task(reader()) for _ in range(num_readers)]
+    await asyncio.gather(*(tracer() for _ in range(num_jobs)))
+    for _ in readers:
+        read_queue.put_nowait(None)
+    await asyncio.gather(*readers)
+    progress.close()
+    return Bf_dict, Bp_dict
+
+
+def collect(argv: list[str] | None = None):
+    """Collect traces and store them as a statistics shard."""
+    parser = argparse.ArgumentParser(
+        description="Collect traces with a tracer command and store them as a "
+        "statistics shard",
+        epilog=f"Example: default collect -c inputs -n non_crashing_inputs -o traces "
+        f"-s traces.json.gz -- pin -t bbl_tracing.so -o {OUTPUT_PLACEHOLDER} -- "
+        f"binary {INPUT_PLACEHOLDER}",
+    )
+    parser.add_argument(
+        "-c", "--crash_dir", help="Path to directory of crashing inputs", type=Path
+    )
+    parser.add_argument(
+        "-n",
+        "--non_crash_dir",
+        help="Path to directory of non-crashing inputs",
+        type=Path,
+    )
+    parser.add_argument(
+        "-o",
+        "--out_dir",
+        help="Path to output directory for the traces (crashing and non_crashing)",
+        type=Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-s",
+        "--shard",
+        help="Path of the statistics shard (compressed if it ends with .gz)",
+        type=Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="Number of concurrent tracer jobs", type=int, default=8
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        help="Timeout of each tracer job in seconds",
+        type=float,
+        default=120,
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        help="Path to a file of address ranges whose basic blocks are dropped",
+        type=Path,
+    )
+    parser.add_argument(
+        "--exclude_module",
+        help="Only exclude ranges whose line contains this string",
+        action="append",
+    )
+    parser.add_argument(
+        "command",
+        help=f"Tracer command, where {INPUT_PLACEHOLDER} is replaced by the input and "
+        f"{OUTPUT_PLACEHOLDER} by the trace file",
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        parser.error("A tracer command is required")
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
+
+    exclusion_index = None
+    if args.exclude is not None:
+        exclusion_index = build_exclusion_index(
+            parse_exclusion_ranges(args.exclude, args.exclude_module)
+        )
+
+    out_dir = args.out_dir.absolute()
+    jobs = collection_jobs(args.crash_dir, args.non_crash_dir, out_dir)
+    logging.info(f"Collecting {len(jobs)} traces with {args.jobs} concurrent jobs")
+
+    num_readers = os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=num_readers, initializer=_init_worker, initargs=(exclusion_index,)
+    ) as pool:
+        Bf_dict, Bp_dict = asyncio.run(
+            collect_traces(jobs, command, args.jobs, args.timeout, pool, num_readers)
+        )
+
+    # The traces are sorted like when reading them from directories
+    Bf_dict = dict(sorted(Bf_dict.items()))
+    passing = passing_stats([Bp_dict[p] for p in sorted(Bp_dict)])
+    write_shard(args.shard, passing, Bf_dict)
+    logging.info(
+        f"Stored {len(Bp_dict)} non-crashing and {len(Bf_dict)} crashing traces "
+        f"in {args.shard}"
+    )
@@ -25,15 +25,79 @@ In Proceedings of the 44th International Conference on Software Engineering
 """
 
 import argparse
+import json
 import logging
 import sys
-from collections import defaultdict
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from collections.abc import Callable
 from math import log2
 from pathlib import Path
 
 from tqdm import tqdm
 
-from default.ground_truth_analysis import analyze_clustering_performance
+from default.ground_truth_analysis import (
+    COMPACT_GROUPS_FILE,
+    IncrementalScores,
+    analyze_clustering_performance,
+    statistical_scores,
+)
+from default.precluster import expand_groups, precluster
+from default.shards import (
+    PassingStats,
+    merge_shards,
+    passing_stats,
+    write_shard,
+)
+
+try:
+    from default import kernels
+except ImportError:
+    kernels = None  # type: ignore[assignment]
+
+# Use the JIT-compiled kernels for the hot loops by default if Numba is installed
+USE_JIT = kernels is not None
+
+# Number of candidates with the largest mutual information that are stored in the
+# decision log and evaluated again when starting from a previous decision
+NUM_DECISION_CANDIDATES = 16
+
+# Name of the file in the output directory that stores the decision log
+DECISION_LOG_FILE = "decisions.json"
+
+# Name of the file in the output directory that stores the comparison of
+# multi-split rounds with sequential rounds
+MULTI_SPLIT_CHECK_FILE = "multi_split_check.json"
+
+# Number of crashing candidates with the largest mutual information among which
+# the one with the largest group is chosen if the time budget is tight
+NUM_ANYTIME_CANDIDATES = 4
+
+# The time budget is tight if fewer rounds than this of the duration of the
+# previous round fit into the remaining time
+NUM_ANYTIME_ROUNDS = 4
+
+
+# Occurrence dictionaries ci, cfi and cpi of basic blocks (see compute_dicts)
+OccurrenceDicts = tuple[
+    dict[str, defaultdict[int, int]],
+    dict[str, defaultdict[int, int]],
+    dict[str, defaultdict[int, int]],
+]
+
+# Candidate blocks with their mutual information and maximum number of occurrences
+RankedBlocks = list[tuple[str, float, int]]
+
+
+class TimeBudgetExceeded(Exception):
+    """Raised when the time budget of the deduplication is used up."""
+
+
+def check_deadline(deadline: float | None):
+    """Raise TimeBudgetExceeded if the deadline has passed."""
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeBudgetExceeded
 
 
 def entropy(Nf: int, Np: int) -> float:
@@ -48,13 +112,17 @@ def entropy(Nf: int, Np: int) -> float:
 
 
 def compute_dicts(
-    unique_b: set[str], Bf: list[dict[str, int]], Bp: list[dict[str, int]]
-) -> tuple[
-    dict[str, defaultdict[int, int]],
-    dict[str, defaultdict[int, int]],
-    dict[str, defaultdict[int, int]],
-]:
-    """Compute the occurrence dictionaries for basic blocks."""
+    unique_b: set[str],
+    Bf: list[dict[str, int]],
+    passing: PassingStats,
+    Wf: list[int] | None = None,
+    deadline: float | None = None,
+) -> OccurrenceDicts:
+    """Compute the occurrence dictionaries for basic blocks.
+
+    If Wf is given, each crashing trace counts as many times as its weight.
+    Raises TimeBudgetExceeded if the deadline passes.
+    """
     logging.info(f"Computing occurrence dictionaries for {len(unique_b)} basic blocks")
 
     ci_dict: dict[str, defaultdict[int, int]] = {}
@@ -65,17 +133,20 @@ def compute_dicts(
         cfi_dict[b] = defaultdict(int)
         cpi_dict[b] = defaultdict(int)
 
-    for trace in tqdm(Bf):
+    for k, trace in enumerate(tqdm(Bf)):
+        check_deadline(deadline)
+        w = 1 if Wf is None else Wf[k]
         for b in unique_b:
             num = trace.get(b, 0)
-            ci_dict[b][num] += 1
-            cfi_dict[b][num] += 1
+            ci_dict[b][num] += w
+            cfi_dict[b][num] += w
 
-    for trace in tqdm(Bp):
+    Np, passing_hist = passing
+    if Np > 0:
         for b in unique_b:
-            num = trace.get(b, 0)
-            ci_dict[b][num] += 1
-            cpi_dict[b][num] += 1
+            for num, n in passing_hist.get(b, {0: Np}).items():
+                ci_dict[b][num] += n
+                cpi_dict[b][num] += n
 
     logging.info("Finished computing occurrence dictionaries for basic blocks")
     return ci_dict, cfi_dict, cpi_dict
@@ -90,26 +161,33 @@ def csum(b: str, lower: int, upper: int, c: dict[str, defaultdict[int, int]]) ->
     return res
 
 
-def maxnb(b: str, D: list[dict[str, int]]) -> int:
+def maxnb(
+    b: str,
+    D: list[dict[str, int]],
+    passing_hist: dict[str, dict[int, int]] | None = None,
+) -> int:
     """Compute the maximum number of occurrences of basic block b in traces."""
-    return max(trace.get(b, 0) for trace in D)
+    m = max(trace.get(b, 0) for trace in D)
+    if passing_hist is not None and b in passing_hist:
+        m = max(m, max(passing_hist[b]))
+    return m
 
 
 def mutual_info(
     b: str,
-    Bf: list[dict[str, int]],
-    Bp: list[dict[str, int]],
+    N: int,
     Hy: float,
     ci: dict[str, defaultdict[int, int]],
     cfi: dict[str, defaultdict[int, int]],
     cpi: dict[str, defaultdict[int, int]],
     m: int,
+    use_jit: bool = USE_JIT,
 ) -> float:
     """Compute the mutual information of basic block b."""
     Hyb: float = 0
-    Nf = len(Bf)
-    Np = len(Bp)
-    N = Nf + Np
+
+    if use_jit:
+        return kernels.mutual_info(b, N, Hy, ci, cfi, cpi, m)
 
     for i in range(0, m + 1):
         ci_current = ci[b].get(i, 0)
@@ -219,8 +297,12 @@ def thd_hat(
     cfi: dict[str, defaultdict[int, int]],
     cpi: dict[str, defaultdict[int, int]],
     m: int,
+    use_jit: bool = USE_JIT,
 ) -> int:
     """Find the threshold that maximizes the mutual information of basic block b."""
+    if use_jit:
+        return kernels.thd_hat(b, N, Hy, ci, cfi, cpi, m)
+
     max_mi = float("-inf")
     best_thd = 0
 
@@ -254,26 +336,196 @@ def is_crashing(
         return True
 
 
+def search_best_block(
+    Bf: list[dict[str, int]],
+    passing: PassingStats,
+    Hy: float,
+    deadline: float | None = None,
+    num_largest: int = 1,
+    Wf: list[int] | None = None,
+    use_jit: bool = USE_JIT,
+) -> tuple[str | None, float, int, OccurrenceDicts, RankedBlocks]:
+    """Find the crashing basic block with the largest mutual information.
+
+    Returns the block, its mutual information and threshold, the occurrence
+    dictionaries and the candidates with the largest mutual information.
+    If num_largest is larger than 1, the block with the largest group among the
+    num_largest crashing blocks with the largest mutual information is chosen.
+    Raises TimeBudgetExceeded if the deadline passes during the search.
+    Each crashing trace counts as many times as its weight in Wf if given.
+    """
+    Nf = len(Bf) if Wf is None else sum(Wf)
+    Np, passing_hist = passing
+    N = Nf + Np
+
+    unique_b = {b for trace in Bf for b in trace.keys()} | passing_hist.keys()
+    ci, cfi, cpi = compute_dicts(unique_b, Bf, passing, Wf, deadline)
+
+    b_mi_dict: dict[str, tuple[float, int]] = {}
+    best_b = None
+    best_mi = float("-inf")
+    best_thd = 0
+    logging.info("Collecting basic blocks from traces")
+    handled_b = set()
+    # The blocks of the non-crashing traces follow in order of first occurrence
+    for trace in tqdm([*Bf, passing_hist]):
+        check_deadline(deadline)
+        for b in trace:
+            if b in handled_b:
+                continue
+            else:
+                m = maxnb(b, Bf, passing_hist)
+                mi = mutual_info(b, N, Hy, ci, cfi, cpi, m, use_jit)
+                if mi > best_mi:
+                    b_mi_dict[b] = (mi, m)
+                handled_b.add(b)
+
+    logging.info(
+        f"Looking for basic block with largest mutual information among "
+        f"{len(b_mi_dict)} candidates"
+    )
+
+    ranked_b = sorted(b_mi_dict.items(), key=lambda kv: kv[1][0], reverse=True)
+    num_crashing = 0
+    best_size = 0
+    for b, (mi, m) in ranked_b:
+        check_deadline(deadline)
+        thd = thd_hat(b, N, Hy, ci, cfi, cpi, m, use_jit)
+        if is_crashing(b, Nf, Np, thd, cfi, cpi, m):
+            num_crashing += 1
+            # Ties keep the block with the larger mutual information
+            size = csum(b, thd + 1, m, cfi)
+            if size > best_size or best_b is None:
+                best_mi = mi
+                best_b = b
+                best_thd = thd
+                best_size = size
+            if num_crashing >= num_largest:
+                break
+        else:
+            logging.debug(
+                f"Basic block {b} with mutual information {mi} threshold "
+                f"{thd} is not crashing, skipping"
+            )
+
+            continue
+
+    candidates = [(b, mi, m) for b, (mi, m) in ranked_b[:NUM_DECISION_CANDIDATES]]
+    return best_b, best_mi, best_thd, (ci, cfi, cpi), candidates
+
+
+def check_decision(
+    decision: dict,
+    Bf: list[dict[str, int]],
+    passing: PassingStats,
+    Hy: float,
+    Wf: list[int] | None = None,
+    use_jit: bool = USE_JIT,
+    deadline: float | None = None,
+) -> tuple[str | None, float, int, OccurrenceDicts, RankedBlocks]:
+    """Check if the block of a previous decision is still the best one.
+
+    Only the candidates of the previous decision are evaluated on the current
+    traces. The previous block is kept if it is still the first crashing one
+    among them when ordered by mutual information, otherwise None is returned.
+    Blocks outside of the candidates are not evaluated, so a block that has
+    become better than all of them is missed and the grouping can differ from
+    the one of a full search. Raises TimeBudgetExceeded if the deadline passes.
+    """
+    Nf = len(Bf) if Wf is None else sum(Wf)
+    Np, passing_hist = passing
+    N = Nf + Np
+
+    prev_b = decision["block"]
+    shortlist = [prev_b] + [b for b in decision["candidates"] if b != prev_b]
+    ci, cfi, cpi = compute_dicts(set(shortlist), Bf, passing, Wf, deadline)
+
+    b_mi_dict: dict[str, tuple[float, int]] = {}
+    for b in shortlist:
+        m = maxnb(b, Bf, passing_hist)
+        # Like in the full search, only blocks that occur in some trace qualify
+        if m > 0:
+            b_mi_dict[b] = (mutual_info(b, N, Hy, ci, cfi, cpi, m, use_jit), m)
+
+    ranked_b = sorted(b_mi_dict.items(), key=lambda kv: kv[1][0], reverse=True)
+    candidates = [(b, mi, m) for b, (mi, m) in ranked_b]
+    for b, (mi, m) in ranked_b:
+        thd = thd_hat(b, N, Hy, ci, cfi, cpi, m, use_jit)
+        if is_crashing(b, Nf, Np, thd, cfi, cpi, m):
+            if b == prev_b:
+                return b, mi, thd, (ci, cfi, cpi), candidates
+            break
+
+    return None, float("-inf"), 0, (ci, cfi, cpi), candidates
+
+
 def deduplication(
-    Bf_dict: dict[Path, dict[str, int]], Bp_dict: dict[Path, dict[str, int]]
+    Bf_dict: dict[Path, dict[str, int]],
+    passing: PassingStats,
+    decision_log: list[dict] | None = None,
+    warm_start: list[dict] | None = None,
+    deadline: float | None = None,
+    weights: dict[Path, int] | None = None,
+    num_splits: int = 1,
+    on_group: Callable[[list[Path]], bool] | None = None,
+    use_jit: bool = USE_JIT,
 ) -> list[list[Path]]:
-    """Deduplicate crashing and non-crashing traces."""
+    """Deduplicate crashing and non-crashing traces.
+
+    The non-crashing traces are given by their passing_stats. The block,
+    threshold and candidates of each round are appended to decision_log. If the
+    decision log of a previous run is given as warm_start, each round first checks
+    the decision of the same round of that run and only searches all blocks if it
+    does not hold anymore.
+
+    If a deadline in terms of time.monotonic() is given, the deduplication stops
+    once it has passed and adds the remaining crashing traces as one group, just
+    as if no more progress could be made. To find large groups early, a round
+    chooses the block with the largest group among the crashing blocks with the
+    largest mutual information once the remaining time is tight, i.e., less than
+    NUM_ANYTIME_ROUNDS times the duration of the previous round. Before that,
+    the rounds are the same as without a deadline.
+
+    If weights are given, each crashing trace stands for as many traces as its
+    weight, e.g., for the representatives of near-duplicate traces.
+
+    If num_splits is larger than 1, each round takes up to num_splits groups
+    among its candidates whose traces are disjoint from the groups already taken
+    in the round, see disjoint_splits. The decisions of a round share its
+    number in decision_log and warm_start is matched by rounds.
+
+    If use_jit is False, the pure-Python implementation is used even if the
+    JIT-compiled kernels are available.
+
+    If on_group is given, it is called with every new group. If it returns
+    True, the deduplication stops and adds the remaining crashing traces as one
+    group.
+    """
     groups: list[list[Path]] = []
+
+    def add_group(group: list[Path]) -> bool:
+        groups.append(group)
+        return on_group is not None and on_group(group)
+
+    if warm_start is not None:
+        warm_start = round_decisions(warm_start)
     prev_len = float("inf")
-    while len(Bf_dict) > 0 and len(Bp_dict) > 0:
+    round_seconds = None
+    num_rounds = 0
+    Np = passing[0]
+    while len(Bf_dict) > 0 and Np > 0:
+        round_start = time.monotonic()
         Bf = list(Bf_dict.values())
-        Bp = list(Bp_dict.values())
+        Wf = None if weights is None else [weights[p] for p in Bf_dict]
 
-        Nf = len(Bf)
-        Np = len(Bp)
-        N = Nf + Np
+        Nf = len(Bf) if Wf is None else sum(Wf)
         logging.info(
             f"Number of crashing traces: {Nf}, Number of non-crashing traces: {Np}"
         )
 
         if prev_len <= Nf:
             trace_list: list[Path] = list(Bf_dict.keys())
-            groups.append(trace_list)
+            add_group(trace_list)
             logging.warning("No more progress can be made")
             logging.warning("Adding remaining traces as one group")
             logging.debug(f"Traces are: {trace_list}")
@@ -281,50 +533,43 @@ def deduplication(
 
         prev_len = Nf
 
-        D = Bf + Bp
-        unique_b = {b for trace in D for b in trace.keys()}
-        ci, cfi, cpi = compute_dicts(unique_b, Bf, Bp)
-
         Hy = entropy(Nf, Np)
 
-        b_mi_dict: dict[str, tuple[float, int]] = {}
         best_b = None
-        best_mi = float("-inf")
-        best_thd = 0
-        logging.info("Collecting basic blocks from traces")
-        handled_b = set()
-        for trace in tqdm(D):
-            for b in trace:
-                if b in handled_b:
-                    continue
+        try:
+            check_deadline(deadline)
+            if warm_start is not None and num_rounds < len(warm_start):
+                decision = warm_start[num_rounds]
+                best_b, best_mi, best_thd, dicts, ranked = check_decision(
+                    decision, Bf, passing, Hy, Wf, use_jit, deadline
+                )
+                if best_b is None:
+                    logging.info(
+                        f"Basic block {decision['block']} of the previous run is not "
+                        f"the best one anymore, searching all basic blocks"
+                    )
                 else:
-                    m = maxnb(b, D)
-                    mi = mutual_info(b, Bf, Bp, Hy, ci, cfi, cpi, m)
-                    if mi > best_mi:
-                        b_mi_dict[b] = (mi, m)
-                    handled_b.add(b)
-
-        logging.info(
-            f"Looking for basic block with largest mutual information among "
-            f"{len(b_mi_dict)} candidates"
-        )
-
-        for b, (mi, m) in sorted(
-            b_mi_dict.items(), key=lambda kv: kv[1][0], reverse=True
-        ):
-            thd = thd_hat(b, N, Hy, ci, cfi, cpi, m)
-            if is_crashing(b, Nf, Np, thd, cfi, cpi, m):
-                best_mi = mi
-                best_b = b
-                best_thd = thd
-                break
-            else:
-                logging.debug(
-                    f"Basic block {b} with mutual information {mi} threshold "
-                    f"{thd} is not crashing, skipping"
+                    logging.info(f"Reusing basic block {best_b} of the previous run")
+
+            if best_b is None:
+                num_largest = 1
+                if (
+                    deadline is not None
+                    and round_seconds is not None
+                    and deadline - time.monotonic() < NUM_ANYTIME_ROUNDS * round_seconds
+                ):
+                    logging.info("Time budget is tight, preferring large groups")
+                    num_largest = NUM_ANYTIME_CANDIDATES
+                best_b, best_mi, best_thd, dicts, ranked = search_best_block(
+                    Bf, passing, Hy, deadline, num_largest, Wf, use_jit
                 )
-
-                continue
+        except TimeBudgetExceeded:
+            trace_list = list(Bf_dict.keys())
+            add_group(trace_list)
+            logging.warning("Time budget is used up")
+            logging.warning("Adding remaining traces as one group")
+            logging.debug(f"Traces are: {trace_list}")
+            return groups
 
         if best_b is None:
             logging.warning("No non-filtered basic found.")
@@ -335,6 +580,9 @@ def deduplication(
             f"threshold {best_thd}"
         )
 
+        cfi = dicts[1]
+        candidates = [b for b, _, _ in ranked]
+
         # The starting index is missing in the paper (it has to be 0)
         sum_cfi = csum(best_b, 0, best_thd, cfi)
 
@@ -343,61 +591,397 @@ def deduplication(
         # but we leave it here for clarity
         if sum_cfi == 0:
             logging.info(f"Basic block {best_b} is present in all crashing traces.")
-            groups.append(list(Bf_dict.keys()))
+            add_group(list(Bf_dict.keys()))
+            if decision_log is not None:
+                decision_log.append(
+                    decision_entry(
+                        best_b, best_thd, best_mi, Nf, candidates, num_rounds
+                    )
+                )
             return groups
-        else:
+        splits = [(best_b, best_mi, best_thd)]
+        if num_splits > 1:
+            splits += disjoint_splits(
+                Bf,
+                passing,
+                Hy,
+                dicts,
+                ranked,
+                best_b,
+                best_thd,
+                num_splits - 1,
+                Wf,
+                use_jit,
+            )
+        for b, mi, thd in splits:
             new_Bf_dict = {
-                p: trace
-                for p, trace in Bf_dict.items()
-                if trace.get(best_b, 0) > best_thd
+                p: trace for p, trace in Bf_dict.items() if trace.get(b, 0) > thd
             }
-            logging.info(f"New group of {len(new_Bf_dict)} traces")
+            group_size = (
+                len(new_Bf_dict)
+                if weights is None
+                else sum(weights[p] for p in new_Bf_dict)
+            )
+            logging.info(f"New group of {group_size} traces")
             trace_list_str = "\n".join([str(p) for p in new_Bf_dict.keys()])
             logging.debug(f"Traces are: {trace_list_str}")
-            groups.append(list(new_Bf_dict.keys()))
+            stop = add_group(list(new_Bf_dict.keys()))
+            if decision_log is not None:
+                decision_log.append(
+                    decision_entry(b, thd, mi, group_size, candidates, num_rounds)
+                )
             Bf_dict = {p: trace for p, trace in Bf_dict.items() if p not in new_Bf_dict}
+            if stop:
+                if Bf_dict:
+                    # The remaining traces are not passed to on_group again
+                    trace_list = list(Bf_dict.keys())
+                    groups.append(trace_list)
+                    logging.warning("Stopping early")
+                    logging.warning("Adding remaining traces as one group")
+                    logging.debug(f"Traces are: {trace_list}")
+                return groups
+
+        round_seconds = time.monotonic() - round_start
+        num_rounds += 1
 
     return groups
 
 
-def preprocess_traces(paths: list[Path]) -> dict[Path, dict[str, int]]:
-    """Read traces from files and count occurrences of addresses."""
-    result: dict[Path, dict[str, int]] = {}
+def round_metrics(
+    scores: IncrementalScores,
+    stop_purity: float | None = None,
+    stop_min_groups: int = 1,
+) -> Callable[[list[Path]], bool]:
+    """Create an on_group callback for deduplication that logs the scores.
 
-    logging.info(f"Preprocessing {len(paths)} trace files")
-    for path in tqdm(paths):
-        address_counts: dict[str, int] = {}
+    The callback adds each group to scores and logs them. If stop_purity is
+    given, it asks to stop once the purity of the traces grouped so far is
+    below it, but not before stop_min_groups groups have been added.
+    """
 
-        with path.open("r", encoding="utf-8") as f:
-            for raw_line in f:
-                # New version with traces containing addresses and counts
-                if not raw_line.strip():
-                    # Skip empty lines
-                    continue
+    def on_group(group: list[Path]) -> bool:
+        scores.add_group(group)
+        current = scores.scores()
+        logging.info(
+            f"Scores after {scores.num_grouped} of {scores.N} traces: "
+            f"purity {current['purity']}, inverse purity {current['inverse_purity']}, "
+            f"F-measure {current['f_measure']}, purity of grouped traces "
+            f"{current['grouped_purity']}"
+        )
+        if (
+            stop_purity is not None
+            and scores.num_groups >= stop_min_groups
+            and current["grouped_purity"] < stop_purity
+        ):
+            logging.warning(
+                f"Purity of grouped traces {current['grouped_purity']} is below "
+                f"{stop_purity}"
+            )
+            return True
+        return False
+
+    return on_group
+
+
+def expanding(
+    on_group: Callable[[list[Path]], bool], buckets: dict[Path, list[Path]]
+) -> Callable[[list[Path]], bool]:
+    """Pass groups of bucket representatives to on_group with all their traces."""
+    return lambda group: on_group(expand_groups([group], buckets)[0])
 
-                line_split = raw_line.split()
-                if len(line_split) != 2:
+
+def disjoint_splits(
+    Bf: list[dict[str, int]],
+    passing: PassingStats,
+    Hy: float,
+    dicts: OccurrenceDicts,
+    candidates: RankedBlocks,
+    best_b: str,
+    best_thd: int,
+    num_splits: int,
+    Wf: list[int] | None = None,
+    use_jit: bool = USE_JIT,
+) -> list[tuple[str, float, int]]:
+    """Find further groups for the current round among its candidates.
+
+    The candidates are evaluated in order of their mutual information with the
+    occurrence dictionaries of the round. A crashing candidate is taken if its
+    group does not overlap with the group of best_b or of the candidates taken
+    before. Returns the block, mutual information and threshold of up to
+    num_splits candidates.
+    """
+    Nf = len(Bf) if Wf is None else sum(Wf)
+    Np = passing[0]
+    N = Nf + Np
+    ci, cfi, cpi = dicts
+
+    taken = {k for k, trace in enumerate(Bf) if trace.get(best_b, 0) > best_thd}
+    splits: list[tuple[str, float, int]] = []
+    for b, mi, m in candidates:
+        if len(splits) >= num_splits:
+            break
+        if b == best_b or m == 0:
+            continue
+        thd = thd_hat(b, N, Hy, ci, cfi, cpi, m, use_jit)
+        if not is_crashing(b, Nf, Np, thd, cfi, cpi, m):
+            continue
+        group = {k for k, trace in enumerate(Bf) if trace.get(b, 0) > thd}
+        if not group or group & taken:
+            continue
+        splits.append((b, mi, thd))
+        taken |= group
+        logging.info(
+            f"Additional basic block: {b} with mutual information {mi} and "
+            f"threshold {thd}"
+        )
+
+    return splits
+
+
+def decision_entry(
+    b: str,
+    thd: int,
+    mi: float,
+    group_size: int,
+    candidates: list[str],
+    round_idx: int,
+) -> dict:
+    """Describe a decision of a deduplication round."""
+    return {
+        "block": b,
+        "threshold": thd,
+        "mutual_information": mi,
+        "group_size": group_size,
+        "candidates": candidates,
+        "round": round_idx,
+    }
+
+
+def round_decisions(decision_log: list[dict]) -> list[dict]:
+    """Get the first decision of every round of a decision log.
+
+    A round of a multi-split run has several decisions. Decisions without a
+    round, e.g., of logs of earlier versions, are one round each.
+    """
+    rounds: dict[int, dict] = {}
+    for idx, decision in enumerate(decision_log):
+        rounds.setdefault(decision.get("round", idx), decision)
+    return list(rounds.values())
+
+
+def parse_exclusion_ranges(
+    path: Path, modules: list[str] | None = None
+) -> list[tuple[int, int]]:
+    """Read address ranges to exclude from a file.
+
+    Each line starts with a range of hexadecimal addresses in the format
+    start-end with an exclusive end, so that /proc/<pid>/maps files can be used
+    directly. If modules are given, only ranges whose line contains one of them,
+    e.g., in the path name of a maps entry, are read.
+    """
+    ranges: list[tuple[int, int]] = []
+    with path.open("r", encoding="utf-8") as f:
+        for raw_line in f:
+            line_split = raw_line.split()
+            if len(line_split) == 0 or line_split[0].startswith("#"):
+                continue
+            if modules is not None and not any(
+                module in raw_line for module in modules
+            ):
+                continue
+
+            start, _, end = line_split[0].partition("-")
+            ranges.append((int(start, 16), int(end, 16)))
+
+    return ranges
+
+
+def build_exclusion_index(
+    ranges: list[tuple[int, int]],
+) -> tuple[list[int], list[int]]:
+    """Merge address ranges to sorted, disjoint start and end lists."""
+    starts: list[int] = []
+    ends: list[int] = []
+    for start, end in sorted(ranges):
+        if len(ends) > 0 and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    return starts, ends
+
+
+def is_excluded(addr: int, exclusion_index: tuple[list[int], list[int]]) -> bool:
+    """Check if an address lies in one of the excluded ranges."""
+    starts, ends = exclusion_index
+    i = bisect_right(starts, addr) - 1
+    return i >= 0 and addr < ends[i]
+
+
+def read_trace(
+    path: Path,
+    exclusion_index: tuple[list[int], list[int]] | None = None,
+    excluded_addrs: dict[str, bool] | None = None,
+) -> dict[str, int]:
+    """Read a trace from a file and count occurrences of addresses.
+
+    Addresses in the ranges of exclusion_index are dropped while reading. The
+    lookups are cached in excluded_addrs if given.
+    """
+    if excluded_addrs is None:
+        excluded_addrs = {}
+    address_counts: dict[str, int] = {}
+
+    with path.open("r", encoding="utf-8") as f:
+        for raw_line in f:
+            # New version with traces containing addresses and counts
+            if not raw_line.strip():
+                # Skip empty lines
+                continue
+
+            line_split = raw_line.split()
+            if len(line_split) != 2:
+                continue
+
+            addr = line_split[0]
+            if exclusion_index is not None:
+                excluded = excluded_addrs.get(addr)
+                if excluded is None:
+                    excluded = is_excluded(int(addr, 16), exclusion_index)
+                    excluded_addrs[addr] = excluded
+                if excluded:
                     continue
 
-                addr = line_split[0]
-                num = int(line_split[1])
-                if addr in address_counts:
-                    address_counts[addr] += num
-                else:
-                    address_counts[addr] = num
+            num = int(line_split[1])
+            if addr in address_counts:
+                address_counts[addr] += num
+            else:
+                address_counts[addr] = num
+
+    return address_counts
+
+
+def preprocess_traces(
+    paths: list[Path],
+    exclusion_index: tuple[list[int], list[int]] | None = None,
+) -> dict[Path, dict[str, int]]:
+    """Read traces from files and count occurrences of addresses.
+
+    Addresses in the ranges of exclusion_index are dropped while reading.
+    """
+    result: dict[Path, dict[str, int]] = {}
+    # Addresses repeat across traces, so each one is only looked up once
+    excluded_addrs: dict[str, bool] = {}
+
+    logging.info(f"Preprocessing {len(paths)} trace files")
+    for path in tqdm(paths):
+        address_counts = read_trace(path, exclusion_index, excluded_addrs)
 
         if len(address_counts) == 0:
             logging.debug(f"File {path} is empty or does not contain any addresses")
             continue
         result[path] = address_counts
 
+    if exclusion_index is not None:
+        logging.info(
+            f"Excluded {sum(excluded_addrs.values())} of {len(excluded_addrs)} "
+            f"distinct basic blocks"
+        )
+
     return result
 
 
-def store_groups(groups: list[list[Path]], output_dir: Path):
-    """Store grouping as file tree."""
+def log2_edges(max_count: int) -> list[int]:
+    """Compute the upper bounds of log2 count bins up to a maximum count."""
+    return [2**k - 1 for k in range(1, max_count.bit_length() + 1)]
+
+
+def quantile_edges(
+    traces: list[dict[Path, dict[str, int]]], num_bins: int
+) -> list[int]:
+    """Compute the upper bounds of count bins with equal frequency in the corpus."""
+    count_hist: Counter[int] = Counter()
+    for trace_dict in traces:
+        for trace in trace_dict.values():
+            count_hist.update(trace.values())
+
+    total = sum(count_hist.values())
+    edges: list[int] = []
+    cumulative = 0
+    for count in sorted(count_hist):
+        cumulative += count_hist[count]
+        # Close a bin whenever the next quantile is reached
+        if cumulative * num_bins >= (len(edges) + 1) * total:
+            edges.append(count)
+
+    return edges
+
+
+def bin_counts(
+    traces: list[dict[Path, dict[str, int]]], binning: str, num_bins: int
+) -> list[int]:
+    """Replace the counts of all traces by the index of their count bin.
+
+    Bin 0 is reserved for absent basic blocks, so that a count of c falls into
+    bin k if edges[k - 2] < c <= edges[k - 1].
+    Since binning preserves the order of counts, a threshold of k on bins
+    corresponds to a threshold of edges[k - 1] on counts.
+    """
+    num_counts = len(
+        {
+            num
+            for trace_dict in traces
+            for t in trace_dict.values()
+            for num in t.values()
+        }
+    )
+
+    if binning == "log2":
+        max_count = max(
+            (max(t.values()) for trace_dict in traces for t in trace_dict.values()),
+            default=0,
+        )
+        edges = log2_edges(max_count)
+        for trace_dict in traces:
+            for trace in trace_dict.values():
+                for b, num in trace.items():
+                    trace[b] = num.bit_length()
+    else:
+        edges = quantile_edges(traces, num_bins)
+        for trace_dict in traces:
+            for trace in trace_dict.values():
+                for b, num in trace.items():
+                    trace[b] = bisect_left(edges, num) + 1
+
+    logging.info(
+        f"Binned {num_counts} distinct counts into {len(edges)} {binning} bins"
+    )
+    logging.info(f"Upper bounds of count bins 1 to {len(edges)}: {edges}")
+
+    return edges
+
+
+def store_groups(groups: list[list[Path]], output_dir: Path, compact: bool = False):
+    """Store grouping as file tree or as a single compact file."""
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    # Group files of an earlier run would be read as groups of this one
+    for stale in output_dir.iterdir():
+        if stale.name.isdigit() and (compact or int(stale.name) >= len(groups)):
+            stale.unlink()
+
+    if compact:
+        compact_groups = {
+            "traces": [str(p) for group in groups for p in group],
+            "labels": [idx for idx, group in enumerate(groups) for _ in group],
+        }
+        with (output_dir / COMPACT_GROUPS_FILE).open("w", encoding="utf-8") as f:
+            json.dump(compact_groups, f)
+        return
+
+    # The ground-truth analysis prefers a compact file of an earlier run
+    (output_dir / COMPACT_GROUPS_FILE).unlink(missing_ok=True)
     for idx, group in enumerate(groups):
         target = output_dir / f"{idx}"
 
@@ -406,6 +990,139 @@ def store_groups(groups: list[list[Path]], output_dir: Path):
                 f.write(str(p) + "\n")
 
 
+def compare_groupings(
+    groups: list[list[Path]], reference: list[list[Path]]
+) -> dict[str, int | float]:
+    """Compare a grouping with a reference grouping.
+
+    The groups of the reference are used as labels for the purity, inverse
+    purity and F-measure, which are all 1 if the groupings are the same.
+    """
+    reference_labels = {
+        p: str(idx) for idx, group in enumerate(reference) for p in group
+    }
+    cluster_list = [idx for idx, group in enumerate(groups) for _ in group]
+    label_list = [reference_labels.get(p, "") for group in groups for p in group]
+    p, ip, f = statistical_scores(cluster_list, label_list)
+
+    reference_sets = {frozenset(group) for group in reference}
+    return {
+        "num_groups": len(groups),
+        "num_reference_groups": len(reference),
+        "num_identical_groups": sum(
+            frozenset(group) in reference_sets for group in groups
+        ),
+        "purity": p,
+        "inverse_purity": ip,
+        "f_measure": f,
+    }
+
+
+def trace_paths(trace_dir: Path) -> list[Path]:
+    """List the trace files in a directory."""
+    return sorted(
+        trace_path.absolute()
+        for trace_path in trace_dir.glob("**/*")
+        if trace_path.is_file()
+    )
+
+
+def read_traces(
+    crash_trace_dir: Path | None,
+    non_crash_trace_dir: Path | None,
+    exclude: Path | None = None,
+    exclude_modules: list[str] | None = None,
+) -> tuple[dict[Path, dict[str, int]], dict[Path, dict[str, int]]]:
+    """Read the crashing and non-crashing traces of two directories."""
+    exclusion_index = None
+    if exclude is not None:
+        exclusion_index = build_exclusion_index(
+            parse_exclusion_ranges(exclude, exclude_modules)
+        )
+        logging.info(f"Excluding {len(exclusion_index[0])} address ranges")
+
+    # List of crashing traces
+    # Each trace is a dictionary with a starting address of a basic block
+    # as a key and the number of occurrences of that basic block in the trace as
+    # a value.
+    Bf_dict: dict[Path, dict[str, int]] = {}
+    if crash_trace_dir is not None:
+        Bf_dict = preprocess_traces(trace_paths(crash_trace_dir), exclusion_index)
+
+    # List of non-crashing traces
+    Bp_dict: dict[Path, dict[str, int]] = {}
+    if non_crash_trace_dir is not None:
+        Bp_dict = preprocess_traces(trace_paths(non_crash_trace_dir), exclusion_index)
+
+    return Bf_dict, Bp_dict
+
+
+def shard_stats(argv: list[str] | None = None):
+    """Summarize local traces in a statistics shard."""
+    parser = argparse.ArgumentParser(
+        description="Summarize traces in a statistics shard that can be merged with "
+        "the shards of other machines"
+    )
+    parser.add_argument(
+        "-c", "--crash_dir", help="Path to directory of crashing traces", type=Path
+    )
+    parser.add_argument(
+        "-n",
+        "--non_crash_dir",
+        help="Path to directory of non-crashing traces",
+        type=Path,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Path of the shard (compressed if it ends with .gz)",
+        type=Path,
+        required=True,
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        help="Path to a file of address ranges whose basic blocks are dropped",
+        type=Path,
+    )
+    parser.add_argument(
+        "--exclude_module",
+        help="Only exclude ranges whose line contains this string",
+        action="append",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
+
+    Bf_dict, Bp_dict = read_traces(
+        args.crash_dir, args.non_crash_dir, args.exclude, args.exclude_module
+    )
+    write_shard(args.output, passing_stats(list(Bp_dict.values())), Bf_dict)
+    logging.info(
+        f"Stored {len(Bp_dict)} non-crashing and {len(Bf_dict)} crashing traces "
+        f"in {args.output}"
+    )
+
+
+def merge_stats(argv: list[str] | None = None):
+    """Merge statistics shards into a single shard."""
+    parser = argparse.ArgumentParser(description="Merge statistics shards")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Path of the merged shard (compressed if it ends with .gz)",
+        type=Path,
+        required=True,
+    )
+    parser.add_argument("shards", help="Paths to the shards", type=Path, nargs="+")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
+
+    passing, Bf_dict = merge_shards(args.shards)
+    write_shard(args.output, passing, Bf_dict)
+
+
 def default():
     """Deduplicate execution traces using mutual information."""
     parser = argparse.ArgumentParser(description="Default deduplication script")
@@ -420,10 +1137,143 @@ def default():
         type=Path,
     )
     parser.add_argument("-o", "--out_dir", help="Path to output directory", type=Path)
+    parser.add_argument(
+        "--compact_groups",
+        help="Store all groups in a single file instead of one file per group",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--count_binning",
+        help="Replace occurrence counts by log2 or corpus quantile bins",
+        choices=["exact", "log2", "quantile"],
+        default="exact",
+    )
+    parser.add_argument(
+        "--num_bins",
+        help="Number of bins for quantile count binning",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        help="Path to a file of address ranges (start-end, e.g., /proc/<pid>/maps) "
+        "whose basic blocks are dropped while reading traces",
+        type=Path,
+    )
+    parser.add_argument(
+        "--exclude_module",
+        help="Only exclude ranges whose line contains this string, e.g., a module "
+        "name in a maps file (can be given multiple times)",
+        action="append",
+    )
+    parser.add_argument(
+        "--warm_start",
+        help=f"Path to the {DECISION_LOG_FILE} of a previous run to start from "
+        "(only the candidates of its rounds are checked, so the groups can differ "
+        "from a run without it)",
+        type=Path,
+    )
+    parser.add_argument(
+        "--no_jit",
+        help="Use the pure-Python implementation even if Numba is installed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--time_budget",
+        "--time-budget",
+        help="Stop the deduplication after this many seconds and add the remaining "
+        "crashing traces as one group",
+        type=float,
+    )
+    parser.add_argument(
+        "--precluster",
+        help="Merge crashing traces whose estimated Jaccard similarity of basic "
+        "blocks to a bucket representative is at least this value (e.g., 0.9) and "
+        "only deduplicate the representatives",
+        type=float,
+        metavar="THRESHOLD",
+    )
+    parser.add_argument(
+        "--precluster_counts",
+        help="Pair basic blocks with the log2 bin of their counts for pre-clustering",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats",
+        help="Paths to statistics shards (see shard-stats) to deduplicate instead "
+        "of the traces of -c and -n",
+        type=Path,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--multi_split",
+        help="Maximum number of disjoint groups that are taken in each round",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--multi_split_check",
+        help="Also deduplicate with one group per round and store the speedup and "
+        f"the differences of the groupings in {MULTI_SPLIT_CHECK_FILE}",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--round_metrics",
+        help="Log purity, inverse purity and F-measure after every round, using the "
+        "parent directories of the crashing traces as bug labels",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stop_purity",
+        help="Stop once the purity of the traces grouped so far falls below this "
+        "value and add the remaining traces as one group (implies --round_metrics)",
+        type=float,
+        metavar="PURITY",
+    )
+    parser.add_argument(
+        "--stop_min_groups",
+        help="Minimum number of groups before --stop_purity can stop the deduplication",
+        type=int,
+        default=3,
+    )
     args = parser.parse_args()
+    if args.num_bins < 1:
+        parser.error("The number of bins has to be at least 1")
+    if args.multi_split < 1:
+        parser.error("The number of groups per round has to be at least 1")
+    if args.stop_purity is not None and not 0 <= args.stop_purity <= 1:
+        parser.error("The purity to stop at has to be between 0 and 1")
+    if args.stop_purity is not None and args.multi_split_check:
+        parser.error(
+            "--multi_split_check compares with a run that does not stop early, so "
+            "it cannot be used with --stop_purity"
+        )
+    if args.time_budget is not None and args.multi_split_check:
+        parser.error(
+            "--multi_split_check compares with a run that does not stop early, so "
+            "it cannot be used with --time_budget"
+        )
+    if args.precluster is not None and not 0 < args.precluster <= 1:
+        parser.error("The pre-clustering threshold has to be in (0, 1]")
+    if args.stats is not None and args.count_binning != "exact":
+        parser.error("Count binning is not supported for statistics shards")
+    if args.stats is not None and (
+        args.crash_dir is not None
+        or args.non_crash_dir is not None
+        or args.exclude is not None
+        or args.exclude_module is not None
+    ):
+        parser.error(
+            "Traces are not read with statistics shards, so -c, -n, -x and "
+            "--exclude_module cannot be used with --stats"
+        )
+
+    # The time budget includes reading the traces
+    deadline = None
+    if args.time_budget is not None:
+        deadline = time.monotonic() + args.time_budget
 
-    crash_trace_dir = args.crash_dir
-    non_crash_trace_dir = args.non_crash_dir
     output_dir = args.out_dir
     logfile = args.log_file
     if logfile is not None and logfile.is_file():
@@ -433,35 +1283,85 @@ def default():
     else:
         logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
 
-    crash_trace_paths = crash_trace_dir.glob("**/*")
-    crash_trace_paths = sorted(
-        [
-            trace_path.absolute()
-            for trace_path in crash_trace_paths
-            if trace_path.is_file()
-        ]
-    )
-    non_crash_trace_paths = non_crash_trace_dir.glob("**/*")
-    non_crash_trace_paths = sorted(
-        [
-            trace_path.absolute()
-            for trace_path in non_crash_trace_paths
-            if trace_path.is_file()
-        ]
-    )
+    use_jit = USE_JIT and not args.no_jit
+    logging.info(f"Using {'JIT-compiled' if use_jit else 'pure-Python'} kernels")
+    if use_jit:
+        # Compile before the deduplication so that it is not part of any timing
+        kernels.warm_up()
 
-    # List of crashing traces
-    # Each trace is a dictionary with a starting address of a basic block
-    # as a key and the number of occurrences of that basic block in the trace as
-    # a value.
-    Bf_dict: dict[Path, dict[str, int]] = preprocess_traces(crash_trace_paths)
+    if args.stats is not None:
+        passing, Bf_dict = merge_shards(args.stats)
+    else:
+        Bf_dict, Bp_dict = read_traces(
+            args.crash_dir, args.non_crash_dir, args.exclude, args.exclude_module
+        )
 
-    # List of non-crashing traces
-    Bp_dict: dict[Path, dict[str, int]] = preprocess_traces(non_crash_trace_paths)
+        if args.count_binning != "exact":
+            bin_counts([Bf_dict, Bp_dict], args.count_binning, args.num_bins)
+
+        passing = passing_stats(list(Bp_dict.values()))
 
-    groups = deduplication(Bf_dict, Bp_dict)
+    warm_start = None
+    if args.warm_start is not None:
+        with args.warm_start.open(encoding="utf-8") as f:
+            warm_start = json.load(f)
+
+    on_group = None
+    if args.round_metrics or args.stop_purity is not None:
+        on_group = round_metrics(
+            IncrementalScores(Bf_dict), args.stop_purity, args.stop_min_groups
+        )
+
+    buckets = None
+    weights = None
+    if args.precluster is not None:
+        buckets = precluster(Bf_dict, args.precluster, args.precluster_counts)
+        weights = {rep: len(traces) for rep, traces in buckets.items()}
+        Bf_dict = {rep: Bf_dict[rep] for rep in buckets}
+        if on_group is not None:
+            on_group = expanding(on_group, buckets)
+
+    decision_log: list[dict] = []
+    start = time.monotonic()
+    groups = deduplication(
+        Bf_dict,
+        passing,
+        decision_log,
+        warm_start,
+        deadline,
+        weights,
+        args.multi_split,
+        on_group,
+        use_jit,
+    )
+    elapsed = time.monotonic() - start
+    if buckets is not None:
+        groups = expand_groups(groups, buckets)
+
+    if args.multi_split_check:
+        logging.info("Deduplicating again with one group per round for comparison")
+        start = time.monotonic()
+        reference = deduplication(
+            Bf_dict, passing, None, warm_start, None, weights, use_jit=use_jit
+        )
+        reference_elapsed = time.monotonic() - start
+        if buckets is not None:
+            reference = expand_groups(reference, buckets)
+
+        check: dict[str, int | float] = {
+            "seconds": elapsed,
+            "reference_seconds": reference_elapsed,
+            "speedup": reference_elapsed / elapsed if elapsed > 0 else 0,
+        }
+        check.update(compare_groupings(groups, reference))
+        logging.info(f"Comparison with one group per round: {check}")
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with (output_dir / MULTI_SPLIT_CHECK_FILE).open("w", encoding="utf-8") as f:
+            json.dump(check, f, indent=2)
     logging.info(f"Number of deduplicated groups: {len(groups)}")
-    store_groups(groups, output_dir)
+    store_groups(groups, output_dir, args.compact_groups)
+    with (output_dir / DECISION_LOG_FILE).open("w", encoding="utf-8") as f:
+        json.dump(decision_log, f, indent=2)
     analyze_clustering_performance(groups, output_dir / "summary")
 
 
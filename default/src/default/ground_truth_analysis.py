@@ -16,45 +16,55 @@
 """Perform ground-truth analysis of deduplication results."""
 
 import argparse
+import csv
 import logging
 from collections import defaultdict
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from json import dump as json_dump
 from json import dumps as json_dumps
+from json import load as json_load
+from os.path import basename, dirname
 from pathlib import Path
+from typing import TextIO
 
+# Name of the single file that stores a grouping in the compact format, i.e., a
+# table of trace paths and the group label of each trace
+COMPACT_GROUPS_FILE = "groups.json"
 
-def get_undercounting(
-    bug_cluster_dict: defaultdict[str, defaultdict[int, int]], summary_path: Path
-) -> int:
-    """Check for clusters that contain traces associated to different bugs."""
-    unique_cluster_labels = {
-        cluster_label
-        for cluster_dict in bug_cluster_dict.values()
-        for cluster_label in cluster_dict.keys()
-    }
 
+def get_cluster_bug_dict(
+    bug_cluster_dict: Mapping[str, Mapping[int, int]],
+) -> dict[int, list[str]]:
+    """Invert the bug-cluster table to the bugs that are assigned to each cluster."""
+    cluster_bug_dict: defaultdict[int, list[str]] = defaultdict(list)
+    for bug_label, cluster_dict in bug_cluster_dict.items():
+        for cluster_label in cluster_dict:
+            cluster_bug_dict[cluster_label].append(bug_label)
+
+    return cluster_bug_dict
+
+
+def get_undercounting(cluster_bug_dict: dict[int, list[str]], summary: TextIO) -> int:
+    """Check for clusters that contain traces associated to different bugs."""
     num_undercounting = 0
-    for cluster_label in unique_cluster_labels:
-        bugs_assigned_to_cluster_label = [
-            bug_label
-            for bug_label, cluster_dict in bug_cluster_dict.items()
-            if cluster_label in cluster_dict
-        ]
+    for cluster_label, bugs_assigned_to_cluster_label in cluster_bug_dict.items():
         if len(bugs_assigned_to_cluster_label) > 1:
             num_undercounting += 1
             logging.info(
                 f"Undercounting present at cluster {cluster_label}: "
                 f"{bugs_assigned_to_cluster_label}"
             )
-            with open(summary_path, "a") as summary:
-                summary.write(
-                    f"Undercounting present at cluster {cluster_label}: "
-                    f"{bugs_assigned_to_cluster_label}\n"
-                )
+            summary.write(
+                f"Undercounting present at cluster {cluster_label}: "
+                f"{bugs_assigned_to_cluster_label}\n"
+            )
     return num_undercounting
 
 
 def get_overcounting(
-    bug_cluster_dict: defaultdict[str, defaultdict[int, int]], summary_path: Path
+    bug_cluster_dict: Mapping[str, Mapping[int, int]], summary: TextIO
 ) -> int:
     """Check for bugs that have traces in multiple clusters."""
     overcounting_list = [
@@ -62,159 +72,112 @@ def get_overcounting(
         for bug_label, cluster_dict in bug_cluster_dict.items()
         if len(cluster_dict) > 1
     ]
-    with open(summary_path, "w") as summary:
-        for oc in overcounting_list:
-            logging.info(f"Overcounting bug_type {oc[0]}: present in {oc[1]} clusters.")
-            summary.write(
-                f"Overcounting bug_type {oc[0]}: present in {oc[1]} clusters.\n"
-            )
+    for oc in overcounting_list:
+        logging.info(f"Overcounting bug_type {oc[0]}: present in {oc[1]} clusters.")
+        summary.write(f"Overcounting bug_type {oc[0]}: present in {oc[1]} clusters.\n")
 
     return len(overcounting_list)
 
 
 def get_lost(
-    bug_cluster_dict: defaultdict[str, defaultdict[int, int]],
+    bug_cluster_dict: Mapping[str, Mapping[int, int]],
+    cluster_bug_dict: dict[int, list[str]],
 ) -> tuple[int, set[str]]:
     """Check for bugs that do not have at least one pure cluster."""
-    num_lost = 0
-    lost_list: set[str] = set()
-    for bug_label in bug_cluster_dict.keys():
-        cluster_dict = bug_cluster_dict[bug_label]
-        other_bug_cluster_dict = {
-            other_bug_label: bug_cluster_dict[other_bug_label]
-            for other_bug_label in bug_cluster_dict
-            if other_bug_label != bug_label
-        }
+    lost_list: set[str] = {
+        bug_label
+        for bug_label, cluster_dict in bug_cluster_dict.items()
         if all(
-            [
-                any(
-                    [
-                        cluster_label in other_cluster_dict
-                        for other_cluster_dict in other_bug_cluster_dict.values()
-                    ]
-                )
-                for cluster_label in cluster_dict
-            ]
-        ):
-            num_lost += 1
-            lost_list.add(bug_label)
-
-    return num_lost, lost_list
-
-
-def index_sets(
+            len(cluster_bug_dict[cluster_label]) > 1 for cluster_label in cluster_dict
+        )
+    }
+
+    return len(lost_list), lost_list
+
+
+def contingency_table(
     cluster_list: list[int], bug_list: list[str]
-) -> tuple[dict[int, set[int]], dict[str, set[int]]]:
-    """Compute index lists that are needed for statistical computations."""
-    index_cluster: dict[int, set[int]] = {}
-    for cluster in set(cluster_list):
-        index_cluster[cluster] = {
-            n
-            for n, other_cluster in enumerate(cluster_list)
-            if other_cluster == cluster
-        }
+) -> defaultdict[str, defaultdict[int, int]]:
+    """Compute the sparse bug-cluster contingency table in a single pass."""
+    table: defaultdict[str, defaultdict[int, int]] = defaultdict(
+        lambda: defaultdict(int)
+    )
+    for cluster, bug in zip(cluster_list, bug_list, strict=True):
+        table[bug][cluster] += 1
+
+    return table
 
-    index_bug: dict[str, set[int]] = {}
-    for bug in set(bug_list):
-        index_bug[bug] = {n for n, other_bug in enumerate(bug_list) if other_bug == bug}
 
-    return index_cluster, index_bug
+def marginals(
+    table: Mapping[str, Mapping[int, int]],
+) -> tuple[dict[int, int], dict[str, int], int]:
+    """Compute cluster sizes, bug sizes and the total number of traces."""
+    cluster_sizes: defaultdict[int, int] = defaultdict(int)
+    bug_sizes: dict[str, int] = {}
+    for bug, cluster_dict in table.items():
+        bug_sizes[bug] = sum(cluster_dict.values())
+        for cluster, count in cluster_dict.items():
+            cluster_sizes[cluster] += count
+
+    return cluster_sizes, bug_sizes, sum(bug_sizes.values())
 
 
 def purity(
-    cluster_list: list[int],
-    bug_list: list[str],
-    index_cluster: dict[int, set[int]],
-    index_bug: dict[str, set[int]],
+    table: Mapping[str, Mapping[int, int]],
+    N: int,
     num_decimal_places: int = 5,
 ) -> float:
     """Compute purity."""
-    purity: float = 0
-    N = len(cluster_list)
-
-    for i in set(cluster_list):
-        C_i = cluster_list.count(i)
-        index_cluster_i = index_cluster[i]
-
-        maxP: float = 0
-        for j in set(bug_list):
-            index_bug_j = index_bug[j]
+    if N == 0:
+        return 0
 
-            intersection = len(index_cluster_i & index_bug_j)
+    # max_j |C_i \cap L_j| for every cluster C_i
+    max_intersection: defaultdict[int, int] = defaultdict(int)
+    for cluster_dict in table.values():
+        for cluster, count in cluster_dict.items():
+            if count > max_intersection[cluster]:
+                max_intersection[cluster] = count
 
-            P = intersection / C_i
-            if P > maxP:
-                maxP = P
-
-        purity += maxP * C_i / N
-
-    return round(purity, num_decimal_places)
+    return round(sum(max_intersection.values()) / N, num_decimal_places)
 
 
 def inverse_purity(
-    cluster_list: list[int],
-    bug_list: list[str],
-    index_cluster: dict[int, set[int]],
-    index_bug: dict[str, set[int]],
+    table: Mapping[str, Mapping[int, int]],
+    N: int,
     num_decimal_places: int = 5,
 ) -> float:
     """Compute inverse purity."""
-    inverse_purity: float = 0
-    N = len(cluster_list)
-
-    for i in set(bug_list):
-        L_i = bug_list.count(i)
-        index_bug_i = index_bug[i]
-
-        maxP: float = 0
-        for j in set(cluster_list):
-            index_cluster_j = index_cluster[j]
-
-            intersection = len(index_bug_i & index_cluster_j)
-
-            P = intersection / L_i
-            if P > maxP:
-                maxP = P
+    if N == 0:
+        return 0
 
-        inverse_purity += maxP * L_i / N
+    # max_j |L_i \cap C_j| for every bug L_i
+    inverse_purity = sum(
+        max(cluster_dict.values(), default=0) for cluster_dict in table.values()
+    )
 
-    return round(inverse_purity, num_decimal_places)
+    return round(inverse_purity / N, num_decimal_places)
 
 
 def f_measure(
-    cluster_list: list[int],
-    bug_list: list[str],
-    index_cluster: dict[int, set[int]],
-    index_bug: dict[str, set[int]],
+    table: Mapping[str, Mapping[int, int]],
+    cluster_sizes: dict[int, int],
+    bug_sizes: dict[str, int],
+    N: int,
     num_decimal_places: int = 5,
 ) -> float:
     """Compute F-measure."""
     f_measure: float = 0
-    N = len(cluster_list)
-
-    C_counts: dict[int, int] = {}
-    for j in set(cluster_list):
-        C_counts[j] = cluster_list.count(j)
 
-    for i in set(bug_list):
-        L_i = bug_list.count(i)
-        index_bug_i = index_bug[i]
+    for bug, cluster_dict in table.items():
+        L_i = bug_sizes[bug]
 
+        # Clusters without an intersection have an F value of 0 and are not
+        # stored in the sparse table
         maxF: float = 0
-        for j in set(cluster_list):
-            C_j = C_counts[j]
-            index_cluster_j = index_cluster[j]
-
-            intersection = len(index_bug_i & index_cluster_j)
-
-            R = intersection / C_j
+        for cluster, intersection in cluster_dict.items():
+            R = intersection / cluster_sizes[cluster]
             P = intersection / L_i
-
-            if R == 0 and P == 0:
-                F: float = 0
-            else:
-                F = 2 * R * P / (R + P)
-
+            F = 2 * R * P / (R + P)
             if F > maxF:
                 maxF = F
 
@@ -223,42 +186,114 @@ def f_measure(
     return round(f_measure, num_decimal_places)
 
 
-def statistical_scores(
-    cluster_list: list[int], bug_list: list[str]
+def contingency_scores(
+    table: Mapping[str, Mapping[int, int]],
 ) -> tuple[float, float, float]:
-    """Compute purity, inverse purity and F-measure."""
-    index_cluster, index_bug = index_sets(cluster_list, bug_list)
+    """Compute purity, inverse purity and F-measure from a contingency table."""
+    cluster_sizes, bug_sizes, N = marginals(table)
 
-    p = purity(cluster_list, bug_list, index_cluster, index_bug)
-    ip = inverse_purity(cluster_list, bug_list, index_cluster, index_bug)
-    f = f_measure(cluster_list, bug_list, index_cluster, index_bug)
+    p = purity(table, N)
+    ip = inverse_purity(table, N)
+    f = f_measure(table, cluster_sizes, bug_sizes, N)
 
     return (p, ip, f)
 
 
+def statistical_scores(
+    cluster_list: list[int], bug_list: list[str]
+) -> tuple[float, float, float]:
+    """Compute purity, inverse purity and F-measure."""
+    return contingency_scores(contingency_table(cluster_list, bug_list))
+
+
+class IncrementalScores:
+    """Purity, inverse purity and F-measure of groups that are added one by one.
+
+    Traces that are not part of a group yet count as misclassified, so the
+    scores only increase and are the same as the ones of contingency_scores
+    once all traces are grouped. Adding a group takes time linear in its size.
+    """
+
+    def __init__(self, trace_paths: Iterable[Path]):
+        """Start without groups for the given crashing traces."""
+        self.bug_sizes: defaultdict[str, int] = defaultdict(int)
+        for trace_path in trace_paths:
+            self.bug_sizes[trace_path.parent.name] += 1
+        self.N = sum(self.bug_sizes.values())
+        self.num_groups = 0
+        self.num_grouped = 0
+        # max_j |C_i \cap L_j| summed over the groups C_i
+        self.max_intersection_sum = 0
+        # max_j |L_i \cap C_j| and max_j F(L_i, C_j) of every bug L_i
+        self.max_intersection: defaultdict[str, int] = defaultdict(int)
+        self.max_f: defaultdict[str, float] = defaultdict(float)
+        self.inverse_purity_sum = 0
+        self.f_measure_sum: float = 0
+
+    def add_group(self, group: list[Path]):
+        """Add a group to the contingency counts."""
+        counts: defaultdict[str, int] = defaultdict(int)
+        for trace_path in group:
+            counts[trace_path.parent.name] += 1
+        if not counts:
+            return
+
+        self.num_groups += 1
+        self.num_grouped += len(group)
+        self.max_intersection_sum += max(counts.values())
+        for bug, intersection in counts.items():
+            if intersection > self.max_intersection[bug]:
+                self.inverse_purity_sum += intersection - self.max_intersection[bug]
+                self.max_intersection[bug] = intersection
+
+            # F = 2RP / (R + P) with R = n / |C| and P = n / |L|
+            L_i = self.bug_sizes[bug]
+            F = 2 * intersection / (len(group) + L_i)
+            if F > self.max_f[bug]:
+                self.f_measure_sum += (F - self.max_f[bug]) * L_i
+                self.max_f[bug] = F
+
+    def scores(self, num_decimal_places: int = 5) -> dict[str, float]:
+        """Compute the scores of the groups added so far.
+
+        Besides purity, inverse purity and F-measure of all traces, the purity
+        of the grouped traces only is returned.
+        """
+        if self.N == 0:
+            return {
+                "purity": 0,
+                "inverse_purity": 0,
+                "f_measure": 0,
+                "grouped_purity": 0,
+            }
+        return {
+            "purity": round(self.max_intersection_sum / self.N, num_decimal_places),
+            "inverse_purity": round(
+                self.inverse_purity_sum / self.N, num_decimal_places
+            ),
+            "f_measure": round(self.f_measure_sum / self.N, num_decimal_places),
+            "grouped_purity": round(
+                self.max_intersection_sum / max(self.num_grouped, 1),
+                num_decimal_places,
+            ),
+        }
+
+
 def get_dist_data(
     groups: list[list[Path]],
-) -> tuple[defaultdict[str, defaultdict[int, int]], list[int], list[str]]:
-    """Produce various structures that contain distribution information."""
+) -> defaultdict[str, defaultdict[int, int]]:
+    """Produce the bug-cluster contingency table of a grouping."""
     # Dictionary that, for each bug type, stores how many associated traces have been
     # assigned to each individual cluster.
     bug_cluster_dict: defaultdict[str, defaultdict[int, int]] = defaultdict(
         lambda: defaultdict(int)
     )
 
-    # List that contain for all (also duplicate) traces the clustering label and the
-    # ground-truth label, in the same order
-    cluster_list: list[int] = []
-    bug_list: list[str] = []
-
     for i, cluster in enumerate(groups):
         for trace_path in cluster:
-            bug_label = trace_path.parent.name
-            bug_cluster_dict[bug_label][i] += 1
-            cluster_list.append(i)
-            bug_list.append(bug_label)
+            bug_cluster_dict[trace_path.parent.name][i] += 1
 
-    return bug_cluster_dict, cluster_list, bug_list
+    return bug_cluster_dict
 
 
 def decimal_to_int_percentage(x: float) -> int:
@@ -266,26 +301,26 @@ def decimal_to_int_percentage(x: float) -> int:
     return int(100 * x + 0.5)
 
 
-def analyze_clustering_performance(
-    groups: list[list[Path]],
-    summary_path: Path,
+def summarize_ground_truth(
+    bug_cluster_dict: Mapping[str, Mapping[int, int]],
+    num_clusters: int,
+    summary: TextIO,
     round: bool = True,
-):
-    """Do ground-truth analysis."""
-    num_clusters = len(groups)
-    bug_cluster_dict, cluster_list, bug_list = get_dist_data(groups)
+) -> dict[str, int | float]:
+    """Compute the ground-truth results of a bug-cluster table."""
+    cluster_bug_dict = get_cluster_bug_dict(bug_cluster_dict)
 
-    num_overcounting = get_overcounting(bug_cluster_dict, summary_path)
-    num_undercounting = get_undercounting(bug_cluster_dict, summary_path)
-    num_lost, lost_list = get_lost(bug_cluster_dict)
-    p, ip, f = statistical_scores(cluster_list, bug_list)
+    num_overcounting = get_overcounting(bug_cluster_dict, summary)
+    num_undercounting = get_undercounting(cluster_bug_dict, summary)
+    num_lost, lost_list = get_lost(bug_cluster_dict, cluster_bug_dict)
+    p, ip, f = contingency_scores(bug_cluster_dict)
 
     if round:
         p = decimal_to_int_percentage(p)
         ip = decimal_to_int_percentage(ip)
         f = decimal_to_int_percentage(f)
 
-    ground_truth_results = {
+    ground_truth_results: dict[str, int | float] = {
         "num_clusters": num_clusters,
         "num_overcount": num_overcounting,
         "num_undercount": num_undercounting,
@@ -295,44 +330,159 @@ def analyze_clustering_performance(
         "f_measure": f,
     }
 
-    with open(summary_path, "a") as summary:
-        logging.info(f"Ground truth analysis:\n{json_dumps(ground_truth_results)}")
-        summary.write(json_dumps(ground_truth_results) + "\n")
-        for b in lost_list:
-            logging.info(f"Bug {b} has no distinct cluster and will be lost")
-            summary.write(f"Bug {b} has no distinct cluster and will be lost\n")
+    logging.info(f"Ground truth analysis:\n{json_dumps(ground_truth_results)}")
+    summary.write(json_dumps(ground_truth_results) + "\n")
+    for b in lost_list:
+        logging.info(f"Bug {b} has no distinct cluster and will be lost")
+        summary.write(f"Bug {b} has no distinct cluster and will be lost\n")
 
+    return ground_truth_results
+
+
+def analyze_clustering_performance(
+    groups: list[list[Path]],
+    summary_path: Path,
+    round: bool = True,
+):
+    """Do ground-truth analysis."""
+    bug_cluster_dict = get_dist_data(groups)
+
+    with open(summary_path, "w") as summary:
+        summarize_ground_truth(bug_cluster_dict, len(groups), summary, round)
+
+
+def read_compact_groups(groups_file: Path) -> tuple[list[str], list[int]]:
+    """Get the trace table and the group label of each trace from a compact file."""
+    with groups_file.open(encoding="utf-8") as g:
+        compact_groups = json_load(g)
+    return compact_groups["traces"], compact_groups["labels"]
+
+
+def read_group_files(group_path: Path) -> list[list[str]]:
+    """Get trace path strings from a compact group file or a group file tree."""
+    compact_groups_file = group_path / COMPACT_GROUPS_FILE
+    if compact_groups_file.is_file():
+        traces, labels = read_compact_groups(compact_groups_file)
+        groups: list[list[str]] = [[] for _ in range(max(labels, default=-1) + 1)]
+        for trace_path, label in zip(traces, labels, strict=True):
+            groups[label].append(trace_path)
+        return [group for group in groups if len(group) > 0]
 
-def parse_groups(group_path: Path) -> list[list[Path]]:
-    """Get path lists from group file tree."""
     group_files = group_path.glob("**/*")
     result = []
     for group in group_files:
-        if group.name == "summary":
+        # Skip the summary and other outputs such as the decision log
+        if group.name == "summary" or group.suffix == ".json":
             continue
 
         with group.open(encoding="utf-8") as g:
-            trace_paths = [Path(line.strip()) for line in g if line.strip()]
+            trace_paths = [line.strip() for line in g if line.strip()]
         if len(trace_paths) > 0:
             result.append(trace_paths)
     return result
 
 
+def parse_groups(group_path: Path) -> list[list[Path]]:
+    """Get path lists from group file tree."""
+    return [
+        [Path(trace_path) for trace_path in group]
+        for group in read_group_files(group_path)
+    ]
+
+
+def analyze_group_output(group_path: Path, summary_path: Path, round: bool = True):
+    """Do ground-truth analysis of stored groups without creating path objects."""
+    groups = read_group_files(group_path)
+    bug_cluster_dict = get_dist_data_from_strings(groups)
+
+    with open(summary_path, "w") as summary:
+        summarize_ground_truth(bug_cluster_dict, len(groups), summary, round)
+
+
+def get_dist_data_from_strings(
+    groups: list[list[str]],
+) -> defaultdict[str, defaultdict[int, int]]:
+    """Produce the bug-cluster contingency table of trace path strings.
+
+    Traces are labeled as in get_dist_data without creating path objects.
+    """
+    bug_cluster_dict: defaultdict[str, defaultdict[int, int]] = defaultdict(
+        lambda: defaultdict(int)
+    )
+
+    for i, cluster in enumerate(groups):
+        for trace_path in cluster:
+            bug_cluster_dict[basename(dirname(trace_path))][i] += 1
+
+    return bug_cluster_dict
+
+
+def score_run(group_path: Path) -> dict[str, str | int | float]:
+    """Compute the ground-truth results of one grouping output directory."""
+    groups = read_group_files(group_path)
+    bug_cluster_dict = get_dist_data_from_strings(groups)
+    results = summarize_ground_truth(bug_cluster_dict, len(groups), StringIO())
+
+    return {"group_path": str(group_path), **results}
+
+
+def sweep(
+    group_paths: list[Path],
+    output_path: Path,
+    jobs: int | None = None,
+) -> list[dict[str, str | int | float]]:
+    """Score many grouping outputs in parallel and store one combined table.
+
+    The table is stored as JSON if output_path ends with .json and as CSV
+    otherwise.
+    """
+    logging.info(f"Scoring {len(group_paths)} grouping outputs")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        rows = list(executor.map(score_run, group_paths))
+
+    with open(output_path, "w", newline="") as output:
+        if output_path.suffix == ".json":
+            json_dump(rows, output, indent=2)
+        else:
+            writer = csv.DictWriter(output, fieldnames=list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return rows
+
+
 def main():
     """Execute ground-truth analysis as standalone script."""
     parser = argparse.ArgumentParser(description="Ground-truth analysis script")
-    parser.add_argument("group_path", help="path to groups", type=Path)
+    parser.add_argument("group_path", help="path to groups", type=Path, nargs="+")
     parser.add_argument(
         "-o",
         "--output_path",
         help="path to output file which stores the results",
         type=Path,
     )
+    parser.add_argument(
+        "-s",
+        "--sweep",
+        help="score all given group paths and store one combined CSV/JSON table",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="number of worker processes in a sweep", type=int
+    )
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
-    groups = parse_groups(args.group_path)
-    analyze_clustering_performance(groups, args.output_path)
+    if args.sweep:
+        if args.output_path is None:
+            parser.error("--sweep requires --output_path")
+        sweep(args.group_path, args.output_path, args.jobs)
+        return
+
+    if len(args.group_path) != 1:
+        parser.error("multiple group paths require --sweep")
+
+    analyze_group_output(args.group_path[0], args.output_path)
 
 
 if __name__ == "__main__":
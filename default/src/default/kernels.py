@@ -0,0 +1,151 @@
+# Copyright 2025 Fraunhofer AISEC
+# Fraunhofer-Gesellschaft zur Förderung der angewandten Forschung e.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""JIT-compiled kernels for the mutual information of basic blocks.
+
+This module requires Numba and is only used if it can be imported.
+The kernels perform the same floating-point operations in the same order as
+the pure-Python functions in default.default, so that their results are
+identical.
+"""
+
+from collections import defaultdict
+from math import log2
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _cond_entropy(sum_cfi: int, sum_cpi: int, N: int) -> float:
+    """Compute the conditional entropy of the traces within a count range."""
+    sum_ci = sum_cfi + sum_cpi
+    if sum_ci == 0:
+        return 0.0
+
+    quot_fi = sum_cfi / sum_ci
+    quot_pi = sum_cpi / sum_ci
+
+    factor_fi = sum_cfi * log2(quot_fi) if sum_cfi > 0 else 0.0
+    factor_pi = sum_cpi * log2(quot_pi) if sum_cpi > 0 else 0.0
+
+    return (-factor_pi - factor_fi) / N
+
+
+@njit(cache=True)
+def _mutual_info(cfi: np.ndarray, cpi: np.ndarray, N: int, Hy: float) -> float:
+    """Compute the mutual information from counts in ascending order."""
+    Hyb = 0.0
+    for k in range(len(cfi)):
+        ci_current = cfi[k] + cpi[k]
+        if ci_current == 0:
+            continue
+
+        cfi_current = cfi[k] / ci_current
+        cpi_current = cpi[k] / ci_current
+
+        cfi_factor = cfi[k] * log2(cfi_current) if cfi_current > 0 else 0.0
+        cpi_factor = cpi[k] * log2(cpi_current) if cpi_current > 0 else 0.0
+
+        Hyb += (cpi_factor + cfi_factor) / N
+
+    return Hy + Hyb
+
+
+@njit(cache=True)
+def _thd_hat(
+    keys: np.ndarray, cfi: np.ndarray, cpi: np.ndarray, N: int, Hy: float, m: int
+) -> int:
+    """Find the best threshold among keys, which are in candidate order."""
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+    # Prefix sums replace the range sums of csum; integer sums are exact
+    prefix_cfi = np.cumsum(cfi[order])
+    prefix_cpi = np.cumsum(cpi[order])
+
+    max_mi = -np.inf
+    best_thd = 0
+    for k in range(len(keys)):
+        thd = keys[k]
+        if thd < 0 or m <= thd:
+            continue
+
+        # All keys are at most m, so the traces above thd are the remaining ones
+        pos = np.searchsorted(sorted_keys, thd, side="right")
+        below_cfi = prefix_cfi[pos - 1] if pos > 0 else 0
+        below_cpi = prefix_cpi[pos - 1] if pos > 0 else 0
+        above_cfi = prefix_cfi[-1] - below_cfi
+        above_cpi = prefix_cpi[-1] - below_cpi
+
+        below = _cond_entropy(below_cfi, below_cpi, N)
+        above = _cond_entropy(above_cfi, above_cpi, N)
+        mi = Hy - below - above
+        if mi > max_mi:
+            max_mi = mi
+            best_thd = thd
+
+    return best_thd
+
+
+def block_arrays(
+    b: str,
+    ci: dict[str, defaultdict[int, int]],
+    cfi: dict[str, defaultdict[int, int]],
+    cpi: dict[str, defaultdict[int, int]],
+    keys: list[int],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Convert the occurrence dictionaries of basic block b to arrays."""
+    return (
+        np.array(keys, dtype=np.int64),
+        np.array([cfi[b].get(i, 0) for i in keys], dtype=np.int64),
+        np.array([cpi[b].get(i, 0) for i in keys], dtype=np.int64),
+    )
+
+
+def mutual_info(
+    b: str,
+    N: int,
+    Hy: float,
+    ci: dict[str, defaultdict[int, int]],
+    cfi: dict[str, defaultdict[int, int]],
+    cpi: dict[str, defaultdict[int, int]],
+    m: int,
+) -> float:
+    """Compute the mutual information of basic block b."""
+    keys = sorted(i for i in ci[b] if 0 <= i <= m)
+    _, cfi_arr, cpi_arr = block_arrays(b, ci, cfi, cpi, keys)
+    return float(_mutual_info(cfi_arr, cpi_arr, N, Hy))
+
+
+def thd_hat(
+    b: str,
+    N: int,
+    Hy: float,
+    ci: dict[str, defaultdict[int, int]],
+    cfi: dict[str, defaultdict[int, int]],
+    cpi: dict[str, defaultdict[int, int]],
+    m: int,
+) -> int:
+    """Find the threshold that maximizes the mutual information of basic block b."""
+    # The candidates keep the order of the dictionary to break ties identically
+    keys_arr, cfi_arr, cpi_arr = block_arrays(b, ci, cfi, cpi, list(ci[b]))
+    return int(_thd_hat(keys_arr, cfi_arr, cpi_arr, N, Hy, m))
+
+
+def warm_up():
+    """Compile the kernels (or load them from the cache) on a trivial block."""
+    table = {"0": defaultdict(int, {0: 1, 1: 1})}
+    mutual_info("0", 2, 1.0, table, table, table, 1)
+    thd_hat("0", 2, 1.0, table, table, table, 1)
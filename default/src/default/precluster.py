@@ -0,0 +1,141 @@
+# Copyright 2025 Fraunhofer AISEC
+# Fraunhofer-Gesellschaft zur Förderung der angewandten Forschung e.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-clustering of near-duplicate traces with MinHash and LSH.
+
+Traces whose basic block sets have an estimated Jaccard similarity of at least
+a threshold to the representative of a bucket are merged into that bucket.
+Only the representatives are deduplicated, each weighted by the size of its
+bucket, and the groups are expanded to all traces of the buckets afterwards.
+"""
+
+import logging
+import random
+from hashlib import blake2b
+from pathlib import Path
+
+from tqdm import tqdm
+
+# The signature consists of NUM_BANDS bands of BAND_ROWS MinHash values each
+NUM_BANDS = 16
+BAND_ROWS = 4
+NUM_HASHES = NUM_BANDS * BAND_ROWS
+
+# Largest prime below 2**32 for the universal hash functions
+PRIME = 4294967291
+
+# Fixed seed so that the buckets are the same in every run
+SEED = 0
+
+
+def hash_functions(num_hashes: int = NUM_HASHES) -> list[tuple[int, int]]:
+    """Draw the coefficients of the universal hash functions."""
+    rng = random.Random(SEED)
+    return [
+        (rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(num_hashes)
+    ]
+
+
+def element_hashes(
+    element: str, coefficients: list[tuple[int, int]]
+) -> tuple[int, ...]:
+    """Compute the values of all hash functions for one element of a trace."""
+    x = int.from_bytes(blake2b(element.encode(), digest_size=8).digest(), "little")
+    return tuple((a * x + c) % PRIME for a, c in coefficients)
+
+
+def trace_elements(trace: dict[str, int], counts: bool) -> list[str]:
+    """Get the elements of a trace that are hashed.
+
+    These are the basic blocks or, if counts is True, the basic blocks paired
+    with the log2 bin of their number of occurrences.
+    """
+    if counts:
+        return [f"{b}:{num.bit_length()}" for b, num in trace.items()]
+    return list(trace)
+
+
+def minhash_signatures(
+    Bf_dict: dict[Path, dict[str, int]], counts: bool = False
+) -> dict[Path, tuple[int, ...]]:
+    """Compute the MinHash signatures of traces."""
+    coefficients = hash_functions()
+    # Basic blocks recur across traces, so their hash values are computed once
+    cache: dict[str, tuple[int, ...]] = {}
+    signatures: dict[Path, tuple[int, ...]] = {}
+    logging.info("Computing MinHash signatures of crashing traces")
+    for p, trace in tqdm(Bf_dict.items()):
+        values = []
+        for element in trace_elements(trace, counts):
+            if element not in cache:
+                cache[element] = element_hashes(element, coefficients)
+            values.append(cache[element])
+        if values:
+            signatures[p] = tuple(map(min, zip(*values, strict=True)))
+        else:
+            signatures[p] = (PRIME,) * NUM_HASHES
+    return signatures
+
+
+def similarity(sig_a: tuple[int, ...], sig_b: tuple[int, ...]) -> float:
+    """Estimate the Jaccard similarity of two traces from their signatures."""
+    return sum(a == b for a, b in zip(sig_a, sig_b, strict=True)) / len(sig_a)
+
+
+def precluster(
+    Bf_dict: dict[Path, dict[str, int]], threshold: float, counts: bool = False
+) -> dict[Path, list[Path]]:
+    """Bucket near-duplicate traces.
+
+    Each trace joins the first bucket that shares a band of its signature and
+    whose representative is at least threshold similar to it, or becomes the
+    representative of a new bucket. Returns the traces of each bucket by their
+    representative.
+    """
+    signatures = minhash_signatures(Bf_dict, counts)
+    band_index: dict[tuple[int, tuple[int, ...]], list[Path]] = {}
+    buckets: dict[Path, list[Path]] = {}
+    for p, sig in signatures.items():
+        bands = [
+            (i, sig[i * BAND_ROWS : (i + 1) * BAND_ROWS]) for i in range(NUM_BANDS)
+        ]
+
+        rep = None
+        for band in bands:
+            for candidate in band_index.get(band, []):
+                if similarity(sig, signatures[candidate]) >= threshold:
+                    rep = candidate
+                    break
+            if rep is not None:
+                break
+
+        if rep is None:
+            buckets[p] = [p]
+            for band in bands:
+                band_index.setdefault(band, []).append(p)
+        else:
+            buckets[rep].append(p)
+
+    logging.info(
+        f"Pre-clustered {len(signatures)} crashing traces into {len(buckets)} buckets"
+    )
+    return buckets
+
+
+def expand_groups(
+    groups: list[list[Path]], buckets: dict[Path, list[Path]]
+) -> list[list[Path]]:
+    """Replace the representatives in groups by all traces of their buckets."""
+    return [[p for rep in group for p in buckets[rep]] for group in groups]
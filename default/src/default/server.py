@@ -0,0 +1,342 @@
+# Copyright 2025 Fraunhofer AISEC
+# Fraunhofer-Gesellschaft zur Förderung der angewandten Forschung e.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-running triage server with a resident passing corpus.
+
+The server computes the occurrence dictionaries of the non-crashing traces once,
+hands a copy to each worker process and keeps the current grouping together
+with the decision log that produced it. New crashing traces are assigned to the group of
+the first decision whose basic block occurs more often than its threshold, like
+in the rounds of deduplication, or to the group of remaining traces otherwise. All
+crashing traces can be deduplicated again at any time, starting from the current
+decisions or from scratch.
+
+Clients send one JSON object per line and receive one JSON object per line.
+The "op" of a request is one of:
+
+- "submit" with "paths" of crashing traces, returns their "groups"
+- "group" with a "path", returns its "group" (null if unknown)
+- "members" with a "group", returns its "paths"
+- "groups", returns the "sizes" of all groups
+- "rededuplicate" and optionally "warm" (true by default), deduplicates all
+  crashing traces again, warm-started from the current decisions unless "warm" is
+  false, returns the "num_groups"
+- "store" with an "out_dir" and optionally "compact", stores the grouping
+- "shutdown", stops the server
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from default.default import (
+    DECISION_LOG_FILE,
+    build_exclusion_index,
+    deduplication,
+    parse_exclusion_ranges,
+    preprocess_traces,
+    store_groups,
+)
+from default.shards import PassingStats, passing_stats
+
+# Passing corpus statistics and exclusion index of a worker process
+_passing: PassingStats = (0, {})
+_exclusion_index: tuple[list[int], list[int]] | None = None
+
+
+def _init_worker(
+    passing: PassingStats, exclusion_index: tuple[list[int], list[int]] | None
+):
+    """Install the passing corpus statistics in a worker process."""
+    global _passing, _exclusion_index
+    _passing = passing
+    _exclusion_index = exclusion_index
+
+
+def _preprocess(paths: list[Path]) -> dict[Path, dict[str, int]]:
+    """Read crashing traces in a worker process."""
+    return preprocess_traces(paths, _exclusion_index)
+
+
+def _deduplicate(
+    Bf_dict: dict[Path, dict[str, int]], warm_start: list[dict] | None
+) -> tuple[list[list[Path]], list[dict]]:
+    """Deduplicate crashing traces against the passing corpus of the worker."""
+    decision_log: list[dict] = []
+    groups = deduplication(Bf_dict, _passing, decision_log, warm_start)
+    return groups, decision_log
+
+
+def assign(trace: dict[str, int], decision_log: list[dict]) -> int:
+    """Find the group of a crashing trace by replaying the decisions.
+
+    Traces that match no decision belong to the group after the last decision,
+    which holds the remaining traces.
+    """
+    for idx, decision in enumerate(decision_log):
+        if trace.get(decision["block"], 0) > decision["threshold"]:
+            return idx
+    return len(decision_log)
+
+
+class TriageState:
+    """Crashing traces, their grouping and the decisions behind it."""
+
+    def __init__(self, pool: ProcessPoolExecutor, num_workers: int = 1):
+        """Start with no crashing traces."""
+        self.pool = pool
+        self.num_workers = num_workers
+        self.Bf_dict: dict[Path, dict[str, int]] = {}
+        self.assignment: dict[Path, int] = {}
+        self.decision_log: list[dict] = []
+        # Deduplication runs exclusively, submissions are assigned in between
+        self.lock = asyncio.Lock()
+
+    def groups(self) -> list[list[Path]]:
+        """Collect the traces of each group."""
+        groups: list[list[Path]] = [[] for _ in range(len(self.decision_log) + 1)]
+        for p, idx in self.assignment.items():
+            groups[idx].append(p)
+        # The group of remaining traces is only kept if it has traces
+        if not groups[-1]:
+            groups.pop()
+        return groups
+
+    async def submit(self, paths: list[Path]) -> dict[str, int | None]:
+        """Read and assign new crashing traces.
+
+        The traces are split into one batch per worker process.
+        """
+        loop = asyncio.get_running_loop()
+        batch_size = max(1, -(-len(paths) // self.num_workers))
+        batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+        batch_traces = await asyncio.gather(
+            *(loop.run_in_executor(self.pool, _preprocess, b) for b in batches)
+        )
+        async with self.lock:
+            for traces in batch_traces:
+                for p, trace in traces.items():
+                    self.Bf_dict[p] = trace
+                    self.assignment[p] = assign(trace, self.decision_log)
+        return {str(p): self.assignment.get(p) for p in paths}
+
+    async def rededuplicate(self, warm: bool = True):
+        """Deduplicate all crashing traces and replace the grouping.
+
+        With warm, the current decisions are used as warm start, which is faster
+        but can miss basic blocks outside of their candidates.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            if not self.Bf_dict:
+                return
+            warm_start = self.decision_log if warm else None
+            groups, decision_log = await loop.run_in_executor(
+                self.pool, _deduplicate, self.Bf_dict, warm_start
+            )
+            self.decision_log = decision_log
+            self.assignment = {
+                p: idx for idx, group in enumerate(groups) for p in group
+            }
+            # Deduplication may stop early, so unassigned traces are replayed
+            for p, trace in self.Bf_dict.items():
+                if p not in self.assignment:
+                    self.assignment[p] = assign(trace, self.decision_log)
+        logging.info(f"Deduplicated {len(self.Bf_dict)} crashing traces")
+
+    def store(self, output_dir: Path, compact: bool):
+        """Store the grouping and the decision log."""
+        store_groups(self.groups(), output_dir, compact)
+        with (output_dir / DECISION_LOG_FILE).open("w", encoding="utf-8") as f:
+            json.dump(self.decision_log, f, indent=2)
+
+
+async def handle_request(
+    state: TriageState, request: dict, stop: asyncio.Event
+) -> dict:
+    """Answer a single request."""
+    op = request.get("op")
+    if op == "submit":
+        paths = [Path(p).absolute() for p in request["paths"]]
+        return {"groups": await state.submit(paths)}
+    elif op == "group":
+        return {"group": state.assignment.get(Path(request["path"]).absolute())}
+    elif op == "members":
+        groups = state.groups()
+        idx = request["group"]
+        if not 0 <= idx < len(groups):
+            raise ValueError(f"There is no group {idx}")
+        return {"paths": [str(p) for p in groups[idx]]}
+    elif op == "groups":
+        return {"sizes": [len(group) for group in state.groups()]}
+    elif op == "rededuplicate":
+        await state.rededuplicate(request.get("warm", True))
+        return {"num_groups": len(state.groups())}
+    elif op == "store":
+        state.store(Path(request["out_dir"]), request.get("compact", False))
+        return {}
+    elif op == "shutdown":
+        stop.set()
+        return {}
+    raise ValueError(f"Unknown operation {op}")
+
+
+async def handle_client(
+    state: TriageState,
+    stop: asyncio.Event,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    """Answer the requests of one client, one JSON object per line."""
+    try:
+        while line := await reader.readline():
+            try:
+                response = await handle_request(state, json.loads(line), stop)
+                response["ok"] = True
+            except Exception as e:
+                logging.warning(f"Request failed: {e!r}")
+                response = {"ok": False, "error": repr(e)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def run_server(
+    state: TriageState, socket_path: Path | None, port: int | None
+) -> None:
+    """Serve requests until a shutdown is requested."""
+    stop = asyncio.Event()
+    clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def client_connected(reader, writer):
+        if stop.is_set():
+            writer.close()
+            return
+        task = asyncio.current_task()
+        assert task is not None
+        clients[task] = writer
+        try:
+            await handle_client(state, stop, reader, writer)
+        finally:
+            del clients[task]
+
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(client_connected, path=socket_path)
+        logging.info(f"Listening on {socket_path}")
+    else:
+        server = await asyncio.start_server(client_connected, "127.0.0.1", port)
+        logging.info(f"Listening on 127.0.0.1:{port}")
+
+    await stop.wait()
+    server.close()
+    # Let connections that were accepted before closing start their handlers
+    await asyncio.sleep(0)
+    # Closing the connections ends their handlers without cancelling them
+    while clients:
+        for writer in list(clients.values()):
+            writer.close()
+        await asyncio.gather(*clients, return_exceptions=True)
+    await server.wait_closed()
+
+    if socket_path is not None:
+        socket_path.unlink(missing_ok=True)
+
+
+def serve(argv: list[str] | None = None):
+    """Run the triage server."""
+    parser = argparse.ArgumentParser(description="Default triage server")
+    parser.add_argument(
+        "-c",
+        "--crash_dir",
+        help="Path to directory of crashing traces that are deduplicated at startup",
+        type=Path,
+    )
+    parser.add_argument(
+        "-n",
+        "--non_crash_dir",
+        help="Path to directory of non-crashing traces",
+        type=Path,
+        required=True,
+    )
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument("-s", "--socket", help="Path of a Unix socket", type=Path)
+    listen.add_argument("-p", "--port", help="Port on localhost", type=int)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes (each keeps a copy of the statistics of "
+        "the non-crashing traces)",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        help="Path to a file of address ranges whose basic blocks are dropped",
+        type=Path,
+    )
+    parser.add_argument(
+        "--exclude_module",
+        help="Only exclude ranges whose line contains this string",
+        action="append",
+    )
+    parser.add_argument(
+        "--warm_start",
+        help=f"Path to the {DECISION_LOG_FILE} of a previous run to start from "
+        "(only the candidates of its rounds are checked, so the groups can differ "
+        "from a full deduplication)",
+        type=Path,
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, force=True)
+
+    exclusion_index = None
+    if args.exclude is not None:
+        exclusion_index = build_exclusion_index(
+            parse_exclusion_ranges(args.exclude, args.exclude_module)
+        )
+
+    non_crash_paths = sorted(
+        p.absolute() for p in args.non_crash_dir.glob("**/*") if p.is_file()
+    )
+    Bp_dict = preprocess_traces(non_crash_paths, exclusion_index)
+    passing = passing_stats(list(Bp_dict.values()))
+    del Bp_dict
+
+    async def main():
+        with ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=_init_worker,
+            initargs=(passing, exclusion_index),
+        ) as pool:
+            state = TriageState(pool, args.jobs)
+            if args.warm_start is not None:
+                with args.warm_start.open(encoding="utf-8") as f:
+                    state.decision_log = json.load(f)
+            if args.crash_dir is not None:
+                crash_paths = sorted(
+                    p.absolute() for p in args.crash_dir.glob("**/*") if p.is_file()
+                )
+                await state.submit(crash_paths)
+                await state.rededuplicate(warm=False)
+            await run_server(state, args.socket, args.port)
+
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+# Copyright 2025 Fraunhofer AISEC
+# Fraunhofer-Gesellschaft zur Förderung der angewandten Forschung e.V.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mergeable statistics of traces.
+
+The occurrence dictionaries of the non-crashing traces are additive, so traces
+on different machines can be summarized in shards that are merged afterwards.
+Crashing traces are kept per trace, since each round of deduplication removes
+some of them. A shard is a JSON file (compressed with gzip if its name ends with
+.gz) of the form
+
+    {
+        "num_passing": <number of non-crashing traces>,
+        "passing": {<basic block>: [[<count>, <number of traces>], ...], ...},
+        "crashing": {<trace path>: {<basic block>: <count>, ...}, ...}
+    }
+"""
+
+import gzip
+import json
+import logging
+from pathlib import Path
+
+from tqdm import tqdm
+
+# Number of non-crashing traces and the occurrence dictionary of each basic block
+# over them, see passing_stats
+PassingStats = tuple[int, dict[str, dict[int, int]]]
+
+
+def passing_stats(Bp: list[dict[str, int]]) -> PassingStats:
+    """Compute the occurrence dictionaries of the non-crashing traces.
+
+    The non-crashing traces do not change between rounds, so their dictionaries
+    are computed once. Basic blocks and their counts are kept in the order of
+    their first occurrence in Bp, which is the order in which the rounds would
+    encounter them in the traces, so that ties are broken identically.
+    """
+    Np = len(Bp)
+    hist: dict[str, dict[int, int]] = {}
+    # Index of the last trace that contains each basic block
+    last: dict[str, int] = {}
+    for i, trace in enumerate(tqdm(Bp)):
+        for b, num in trace.items():
+            c = hist.get(b)
+            if c is None:
+                # Count 0 occurs first if earlier traces do not contain b
+                c = hist[b] = {0: 0} if i > 0 else {}
+            elif last[b] < i - 1 and 0 not in c:
+                c[0] = 0
+            c[num] = c.get(num, 0) + 1
+            last[b] = i
+
+    for b, c in hist.items():
+        if last[b] < Np - 1 and 0 not in c:
+            c[0] = 0
+        if 0 in c:
+            c[0] = Np - sum(n for num, n in c.items() if num != 0)
+
+    return Np, hist
+
+
+def merge_passing_stats(shards: list[PassingStats]) -> PassingStats:
+    """Merge the occurrence dictionaries of disjoint sets of non-crashing traces.
+
+    The result is the same as for the concatenation of the traces in the order
+    of the shards.
+    """
+    Np = 0
+    hist: dict[str, dict[int, int]] = {}
+    for shard_Np, shard_hist in shards:
+        # Basic blocks missing from a shard occur 0 times in all of its traces
+        if shard_Np > 0:
+            for b, c in hist.items():
+                if b not in shard_hist:
+                    c[0] = c.get(0, 0) + shard_Np
+        for b, shard_c in shard_hist.items():
+            if b not in hist:
+                hist[b] = {0: Np} if Np > 0 else {}
+            c = hist[b]
+            for num, n in shard_c.items():
+                c[num] = c.get(num, 0) + n
+        Np += shard_Np
+
+    return Np, hist
+
+
+def write_shard(path: Path, passing: PassingStats, Bf_dict: dict[Path, dict[str, int]]):
+    """Store the statistics of non-crashing traces and the crashing traces."""
+    Np, hist = passing
+    data = json.dumps(
+        {
+            "num_passing": Np,
+            "passing": {b: list(c.items()) for b, c in hist.items()},
+            "crashing": {str(p): trace for p, trace in Bf_dict.items()},
+        }
+    ).encode()
+    if path.suffix == ".gz":
+        data = gzip.compress(data)
+    path.write_bytes(data)
+
+
+def read_shard(path: Path) -> tuple[PassingStats, dict[Path, dict[str, int]]]:
+    """Load the statistics of non-crashing traces and the crashing traces."""
+    data = path.read_bytes()
+    if path.suffix == ".gz":
+        data = gzip.decompress(data)
+    shard = json.loads(data)
+    hist = {b: {num: n for num, n in c} for b, c in shard["passing"].items()}
+    Bf_dict = {Path(p): trace for p, trace in shard["crashing"].items()}
+    return (shard["num_passing"], hist), Bf_dict
+
+
+def merge_shards(
+    paths: list[Path],
+) -> tuple[PassingStats, dict[Path, dict[str, int]]]:
+    """Merge shards in the given order."""
+    shards_passing = []
+    Bf_dict: dict[Path, dict[str, int]] = {}
+    for path in paths:
+        passing, shard_Bf_dict = read_shard(path)
+        shards_passing.append(passing)
+        for p, trace in shard_Bf_dict.items():
+            if p in Bf_dict:
+                logging.warning(f"Crashing trace {p} is contained in multiple shards")
+            Bf_dict[p] = trace
+        logging.info(
+            f"Read shard {path} with {passing[0]} non-crashing and "
+            f"{len(shard_Bf_dict)} crashing traces"
+        )
+    return merge_passing_stats(shards_passing), Bf_dict
@@ -22,10 +22,30 @@ from argparse import ArgumentParser
 import subprocess as sp
 import re
 import pickle
+import json
+import sqlite3
+import struct
 
 CW_PATH = Path(__file__)
 CWDUMP_PATH = CW_PATH.parent / "bin/cwdump"
 CWFIND_PATH = CW_PATH.parent / "bin/cwfind"
+CWDUMP_HASH_RE = re.compile(r'^\(1 of ([\d]+)\) - Hash: (.*)$')
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Cache of all hashes and file paths that is stored next to the database
+CACHE_SUFFIX = ".paths.json"
+
+# Layout of Bolt database files (see github.com/boltdb/bolt)
+BOLT_MAGIC = 0xED0CDAED
+BOLT_VERSION = 2
+BOLT_PAGE_HEADER_SIZE = 16
+BOLT_META_SIZE = 56
+BOLT_ELEMENT_SIZE = 16
+BOLT_BUCKET_HEADER_SIZE = 16
+BOLT_BRANCH_PAGE = 0x01
+BOLT_LEAF_PAGE = 0x02
+BOLT_BUCKET_LEAF = 0x01
 
 NUM_DECIMAL_PLACES = 5
 
@@ -50,106 +70,70 @@ GT_ALL_TARGETS = {
 }
 
 
-def index_sets(result_list, gt_list):
-    """Helper function for computing statistical metrics."""
-    index_cluster = {}
-    for cluster in set(result_list):
-        index_cluster[cluster] = {n for n, x in enumerate(result_list) if x == cluster}
+def contingency_table(result_list, gt_list):
+    """Compute the sparse bug-cluster contingency table in a single pass."""
+    table = defaultdict(lambda: defaultdict(int))
+    for cluster, bug in zip(result_list, gt_list):
+        table[bug][cluster] += 1
 
-    index_bug = {}
-    for bug in set(gt_list):
-        index_bug[bug] = {n for n, x in enumerate(gt_list) if x == bug}
+    return table
 
-    return index_cluster, index_bug
 
+def marginals(table):
+    """Compute cluster sizes, bug sizes and the total number of SCIs."""
+    cluster_sizes = defaultdict(int)
+    bug_sizes = {}
+    for bug, clusters in table.items():
+        bug_sizes[bug] = sum(clusters.values())
+        for cluster, count in clusters.items():
+            cluster_sizes[cluster] += count
 
+    return cluster_sizes, bug_sizes, sum(bug_sizes.values())
 
-def purity(result_list, gt_list, index_cluster, index_bug) -> float:
-    """Compute purity."""
-    purity = 0
-    N = len(result_list)
-
-    for i in set(result_list):
-        # C_i
-        C_i = result_list.count(i)
-        index_cluster_i = index_cluster[i]
-
-        maxP = 0
-        # max_j P(C_i, L_j)
-        for j in set(gt_list):
-            index_bug_j = index_bug[j]
 
-            # C_i \cap L_j
-            intersection = len(index_cluster_i & index_bug_j)
-
-            P = intersection / C_i
-            if P > maxP:
-                maxP = P
+def purity(table, N) -> float:
+    """Compute purity."""
+    if N == 0:
+        return 0
 
-        purity += maxP * C_i / N
+    # max_j |C_i \cap L_j| for every cluster C_i
+    max_intersection = defaultdict(int)
+    for clusters in table.values():
+        for cluster, count in clusters.items():
+            if count > max_intersection[cluster]:
+                max_intersection[cluster] = count
 
-    return round(purity, NUM_DECIMAL_PLACES)
+    return round(sum(max_intersection.values()) / N, NUM_DECIMAL_PLACES)
 
 
-def inverse_purity(result_list, gt_list, index_cluster, index_bug) -> float:
+def inverse_purity(table, N) -> float:
     """Compute inverse purity."""
-    inverse_purity = 0
-    N = len(result_list)
+    if N == 0:
+        return 0
 
-    for i in set(gt_list):
-        # L_i
-        L_i = gt_list.count(i)
-        index_bug_i = index_bug[i]
+    # max_j |L_i \cap C_j| for every bug L_i
+    inverse_purity = sum(max(clusters.values(), default=0) for clusters in table.values())
 
-        maxP = 0
-        # max_j P(L_i, C_j)
-        for j in set(result_list):
-            index_cluster_j = index_cluster[j]
+    return round(inverse_purity / N, NUM_DECIMAL_PLACES)
 
-            # L_i \cap C_j
-            intersection = len(index_bug_i & index_cluster_j)
-
-            P = intersection / L_i
-            if P > maxP:
-                maxP = P
 
-        inverse_purity += maxP * L_i / N
-
-    return round(inverse_purity, NUM_DECIMAL_PLACES)
-
-
-def f_measure(result_list, gt_list, index_cluster, index_bug) -> float:
+def f_measure(table, cluster_sizes, bug_sizes, N) -> float:
     """Compute F-measure."""
     f_measure = 0
-    N = len(result_list)
-
-    C_counts = {}
-    for j in set(result_list):
-        C_counts[j] = result_list.count(j)
-
 
-    for i in set(gt_list):
+    for bug, clusters in table.items():
         # L_i
-        L_i = gt_list.count(i)
-        index_bug_i = index_bug[i]
+        L_i = bug_sizes[bug]
 
         maxF = 0
-        # max_j F(L_i, C_j)
-        for j in set(result_list):
+        # max_j F(L_i, C_j), clusters without intersection are not stored
+        for cluster, intersection in clusters.items():
             # C_j
-            C_j = C_counts[j]
-            index_cluster_j = index_cluster[j]
-
-            # L_i \cap C_j
-            intersection = len(index_bug_i & index_cluster_j)
+            C_j = cluster_sizes[cluster]
 
             R = intersection / C_j
             P = intersection / L_i
-
-            if R == 0 and P == 0:
-                F = 0
-            else:
-                F = 2 * R * P / (R + P)
+            F = 2 * R * P / (R + P)
 
             if F > maxF:
                 maxF = F
@@ -159,17 +143,22 @@ def f_measure(result_list, gt_list, index_cluster, index_bug) -> float:
     return round(f_measure, NUM_DECIMAL_PLACES)
 
 
-def statistical_scores(result_list, gt_list):
-    """Compute purity, inverse purity and F-measure."""
-    index_cluster, index_bug = index_sets(result_list, gt_list)
+def contingency_scores(table):
+    """Compute purity, inverse purity and F-measure from a contingency table."""
+    cluster_sizes, bug_sizes, N = marginals(table)
 
-    p = purity(result_list, gt_list, index_cluster, index_bug)
-    ip = inverse_purity(result_list, gt_list, index_cluster, index_bug)
-    f = f_measure(result_list, gt_list, index_cluster, index_bug)
+    p = purity(table, N)
+    ip = inverse_purity(table, N)
+    f = f_measure(table, cluster_sizes, bug_sizes, N)
 
     return (p, ip, f)
 
 
+def statistical_scores(result_list, gt_list):
+    """Compute purity, inverse purity and F-measure."""
+    return contingency_scores(contingency_table(result_list, gt_list))
+
+
 def decimal_to_int_percentage(x: float) -> int:
     """Convert decimal value to integer percentage."""
     return int(100*x + 0.5)
@@ -177,12 +166,15 @@ def decimal_to_int_percentage(x: float) -> int:
 
 def analyze_clustering_performance(label_dist, num_clusters, result_list, gt_list, round: bool):
     """Do ground-truth analysis."""
-    unique_labels = {l for v in label_dist.values() for l in v.keys()}
+    # Inverted index of the bug types that are assigned to each cluster
+    cluster_bugs = defaultdict(list)
+    for bug_type, clusters in label_dist.items():
+        for l in clusters:
+            cluster_bugs[l].append(bug_type)
 
     # Analyze undercounting (possibly losing bugs)
     uc = 0
-    for l in unique_labels:
-        bug_types_assigned_to_l = [bug_type for bug_type, clusters in label_dist.items() if l in clusters]
+    for l, bug_types_assigned_to_l in cluster_bugs.items():
         if len(bug_types_assigned_to_l) > 1:
             uc += 1
             print(f"Undercounting present at cluster {l}: {bug_types_assigned_to_l}")
@@ -195,10 +187,8 @@ def analyze_clustering_performance(label_dist, num_clusters, result_list, gt_lis
     # Check for completely filtered/lost bugs
     cl = 0
     completely_lost = set()
-    for b in label_dist.keys():
-        clusters = label_dist[b]
-        label_dist_without_self = {x: label_dist[x] for x in label_dist if x != b}
-        if all([any([c in cs for cs in label_dist_without_self.values()]) for c in clusters]):
+    for b, clusters in label_dist.items():
+        if all(len(cluster_bugs[c]) > 1 for c in clusters):
             cl += 1
             completely_lost.add(b)
             print(f"BUG {b} HAS NO DISTINCT CLUSTER. IT WILL BE LOST")
@@ -223,9 +213,37 @@ def analyze_clustering_performance(label_dist, num_clusters, result_list, gt_lis
     return ground_truth_results
 
 
+def load_translation(translation_path):
+    """Get a function that looks up the original path of a generically renamed input.
+
+    Translations stored by rename.py in SQLite are queried lazily, older pickled
+    translations are loaded completely.
+    """
+    with open(translation_path, "rb") as t:
+        is_sqlite = t.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+    if not is_sqlite:
+        with open(translation_path, "rb") as t:
+            translation = {str(i): str(f) for f, i in pickle.load(t).items()}
+        return translation.get
+
+    conn = sqlite3.connect(translation_path)
+
+    def lookup(generic):
+        row = conn.execute("SELECT original FROM translation WHERE generic = ?", (generic,)).fetchone()
+        return None if row is None else row[0]
+
+    return lookup
+
+
 def get_gta_translation(translation_path):
-    """Create translation table from generically renamed inputs to original file names that
-    include ground-truth labeling."""
+    """Create translation from generically renamed inputs to original file names that
+    include ground-truth labeling.
+
+    Returns a function that maps a generically renamed input to its translated path
+    and whether the input is ignored; the path is None if the input is unknown or
+    ignored.
+    """
 
     target = ""
     for p in translation_path.parts:
@@ -233,23 +251,24 @@ def get_gta_translation(translation_path):
             target = p
 
     gt = GT_ALL_TARGETS.get(target, {})
+    lookup = load_translation(translation_path)
 
-    with open(translation_path, "rb") as t:
-        translation = pickle.load(t)
-        gta_translation = {}
-        ignored = []
-        for f, i in translation.items():
-            old_label = f.parent.name
-            new_label = gt.get(old_label)
-            if new_label is None:
-                new_label = old_label
-            if new_label == "":
-                ignored.append(i)
-                continue
+    def gta_translation(generic):
+        original = lookup(generic)
+        if original is None:
+            return None, False
 
-            gta_translation[i] = f.parent.parent / new_label / f.name
+        f = Path(original)
+        old_label = f.parent.name
+        new_label = gt.get(old_label)
+        if new_label is None:
+            new_label = old_label
+        if new_label == "":
+            return None, True
 
-    return gta_translation, ignored
+        return f.parent.parent / new_label / f.name, False
+
+    return gta_translation
 
 
 def get_label_dist(labels, unique_file_paths, duplicates):
@@ -278,52 +297,288 @@ def get_label_dist(labels, unique_file_paths, duplicates):
     return label_dist, result_list, gt_list
 
 
-def prepare_vars(cwdb_path, gta_translation, ignored):
-    """Parse Crashwalk database."""
-    # Get list of hashes
+def read_cwdump(cwdb_path):
+    """Stream the output of cwdump and collect the hashes and their number of crashes."""
     labels = []
+    counts = {}
     try:
-        cwdump = sp.run([CWDUMP_PATH, cwdb_path], stdout=sp.PIPE).stdout.decode("utf-8")
-    except sp.CalledProcessError:
-        print("Call failed")
-        exit(1)
+        with sp.Popen([CWDUMP_PATH, cwdb_path], stdout=sp.PIPE, text=True) as cwdump:
+            for line in cwdump.stdout:
+                match = CWDUMP_HASH_RE.match(line)
+                if match is not None:
+                    labels.append(match.group(2))
+                    counts[match.group(2)] = int(match.group(1))
     except Exception as e:
         print(f"Something else failed: {e}")
         exit(1)
 
-    for line in cwdump.splitlines():
-        if line.startswith("(1 of"):
-            line = re.sub(r'^\(1 of [\d]+\) - Hash: ', '', line)
-            labels.append(line)
-
     print("Collected all labels")
     if len(labels) != len(set(labels)):
         print("There seem to be duplicate hashes in the cwdump")
         exit(1)
 
+    return labels, counts
+
+
+def cwfind(cwdb_path, hs):
+    """Get the file paths of all crashes with a hash using cwfind."""
+    try:
+        output = sp.run([CWFIND_PATH, "-db", cwdb_path, hs], stdout=sp.PIPE).stdout.decode("utf-8")
+    except sp.CalledProcessError:
+        print("Call failed")
+        exit(1)
+    except Exception as e:
+        print(f"Something else failed: {e}")
+        exit(1)
+
+    return output.splitlines()
+
+
+def fnv64a(data):
+    """Compute the 64-bit FNV-1a hash that Bolt uses as meta page checksum."""
+    h = 0xCBF29CE484222325
+    for byte in data:
+        h = ((h ^ byte) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+def bolt_items(db):
+    """Yield (bucket names, key, value) for all entries of a Bolt database."""
+    page_size = struct.unpack_from("<I", db, BOLT_PAGE_HEADER_SIZE + 8)[0]
+
+    # Use the valid meta page of the latest transaction
+    root = None
+    latest_txid = -1
+    for meta_page in (0, 1):
+        meta = meta_page * page_size + BOLT_PAGE_HEADER_SIZE
+        magic, version = struct.unpack_from("<II", db, meta)
+        meta_root, txid, checksum = struct.unpack_from("<Q24xQQ", db, meta + 16)
+        if magic != BOLT_MAGIC or version != BOLT_VERSION:
+            continue
+        if fnv64a(db[meta:meta + BOLT_META_SIZE]) != checksum:
+            continue
+        if txid > latest_txid:
+            root = meta_root
+            latest_txid = txid
+    if root is None:
+        raise ValueError("Not a Bolt database")
+
+    def page_items(buf, offset, names):
+        flags, count = struct.unpack_from("<HH", buf, offset + 8)
+        elements = offset + BOLT_PAGE_HEADER_SIZE
+        if flags & BOLT_BRANCH_PAGE:
+            for i in range(count):
+                element = elements + i * BOLT_ELEMENT_SIZE
+                child = struct.unpack_from("<Q", buf, element + 8)[0]
+                yield from page_items(db, child * page_size, names)
+        elif flags & BOLT_LEAF_PAGE:
+            for i in range(count):
+                element = elements + i * BOLT_ELEMENT_SIZE
+                leaf_flags, pos, ksize, vsize = struct.unpack_from("<IIII", buf, element)
+                key = bytes(buf[element + pos:element + pos + ksize])
+                value = buf[element + pos + ksize:element + pos + ksize + vsize]
+                if leaf_flags & BOLT_BUCKET_LEAF:
+                    yield from bucket_items(value, names + (key,))
+                else:
+                    yield names, key, bytes(value)
+        else:
+            raise ValueError(f"Unexpected page flags {flags}")
+
+    def bucket_items(value, names):
+        bucket_root = struct.unpack_from("<Q", value, 0)[0]
+        if bucket_root == 0:
+            # Inline bucket, the page is stored directly behind the bucket header
+            yield from page_items(value, BOLT_BUCKET_HEADER_SIZE, names)
+        else:
+            yield from page_items(db, bucket_root * page_size, names)
+
+    yield from page_items(db, root * page_size, ())
+
+
+def read_varint(data, pos):
+    """Decode a protobuf varint."""
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def proto_strings(data, prefix=()):
+    """Get (field path, string) for all length-delimited fields of a protobuf message."""
+    result = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if field == 0:
+            raise ValueError("Invalid field number")
+        if wire_type == 0:
+            _, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            chunk = data[pos:pos + length]
+            pos += length
+            if pos > len(data):
+                raise ValueError("Truncated field")
+            # Strings and nested messages share the wire type, so try both
+            try:
+                result.append((prefix + (field,), chunk.decode("utf-8")))
+            except UnicodeDecodeError:
+                pass
+            try:
+                result.extend(proto_strings(chunk, prefix + (field,)))
+            except ValueError:
+                pass
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+    if pos != len(data):
+        raise ValueError("Truncated message")
+
+    return result
+
+
+def record_strings(names, key, value):
+    """Get all strings of a database entry together with the place they were found."""
+    result = []
+    for depth, name in enumerate(names):
+        result.append((("bucket", depth), name.decode("utf-8", errors="replace")))
+    result.append((("key",), key.decode("utf-8", errors="replace")))
+    try:
+        result.extend((("value",) + field, string) for field, string in proto_strings(value))
+    except ValueError:
+        pass
+
+    return result
+
+
+def read_crashwalk_db(cwdb_path, labels, counts):
+    """Get the file paths of all hashes with a single pass over the database.
+
+    Where the hash and the file path of a crash are stored in an entry is
+    calibrated with one cwfind call and checked against the crash counts of
+    cwdump. Returns None if the database cannot be read this way.
+    """
+    if len(labels) == 0:
+        return {}
+
+    label_set = set(labels)
+    try:
+        records = [record_strings(*item) for item in bolt_items(cwdb_path.read_bytes())]
+    except (OSError, ValueError, struct.error, RecursionError) as e:
+        print(f"Could not read crashwalk database directly: {e}")
+        return None
+
+    # The place of the hash is the one that holds a known hash in most entries
+    hash_places = defaultdict(int)
+    for record in records:
+        for place in {place for place, string in record if string in label_set}:
+            hash_places[place] += 1
+    if len(hash_places) == 0:
+        print("Could not find hashes in crashwalk database")
+        return None
+    hash_place = max(hash_places, key=hash_places.get)
+
+    def record_hash(record):
+        for place, string in record:
+            if place == hash_place and string in label_set:
+                return string
+        return None
+
+    # The place of the file path is the one that yields exactly the files that
+    # cwfind reports for one hash
+    calibration_hash = labels[0]
+    calibration_files = set(cwfind(cwdb_path, calibration_hash))
+    path_places = None
+    for record in records:
+        if record_hash(record) != calibration_hash:
+            continue
+        places = {place for place, string in record if string in calibration_files}
+        path_places = places if path_places is None else path_places & places
+    if not path_places:
+        print("Could not find file paths in crashwalk database")
+        return None
+    path_place = min(path_places)
+
+    hash_paths = {hs: [] for hs in labels}
+    for record in records:
+        hs = record_hash(record)
+        if hs is None:
+            continue
+        hash_paths[hs].extend(string for place, string in record if place == path_place)
+
+    if {hs: len(paths) for hs, paths in hash_paths.items()} != counts:
+        print("Crashwalk database entries do not match cwdump")
+        return None
+    if set(hash_paths[calibration_hash]) != calibration_files:
+        print("Crashwalk database entries do not match cwfind")
+        return None
+
+    return hash_paths
+
+
+def get_hash_paths(cwdb_path):
+    """Get all hashes and the file paths of their crashes, cached next to the database."""
+    cache_path = cwdb_path.with_name(cwdb_path.name + CACHE_SUFFIX)
+    mtime = cwdb_path.stat().st_mtime_ns
+
+    # Unreadable caches and caches of an older format are treated as missing
+    try:
+        with open(cache_path, "r") as c:
+            cache = json.load(c)
+        if cache["mtime"] == mtime:
+            labels, hash_paths = cache["labels"], cache["hash_paths"]
+            print("Using cached crashwalk database")
+            return labels, hash_paths
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring cache {cache_path}: {e!r}")
+
+    labels, counts = read_cwdump(cwdb_path)
+    hash_paths = read_crashwalk_db(cwdb_path, labels, counts)
+    if hash_paths is None:
+        print("Falling back to cwfind for every hash")
+        hash_paths = {hs: cwfind(cwdb_path, hs) for hs in labels}
+
+    # The database may be provided read-only, the cache is only an optimization
+    try:
+        with open(cache_path, "w") as c:
+            json.dump({"mtime": mtime, "labels": labels, "hash_paths": hash_paths}, c)
+    except OSError as e:
+        print(f"Not caching crashwalk database: {e!r}")
+
+    return labels, hash_paths
+
+
+def prepare_vars(cwdb_path, gta_translation):
+    """Parse Crashwalk database."""
+    labels, hash_paths = get_hash_paths(cwdb_path)
+
     # For each hash, get one file path and store all duplicates
     unique_file_paths = []
     duplicates = dict()
 
     for hs in labels:
-        try:
-            cwfind = sp.run([CWFIND_PATH, "-db", cwdb_path, hs], stdout=sp.PIPE).stdout.decode("utf-8")
-        except sp.CalledProcessError:
-            print("Call failed")
-            exit(1)
-        except Exception as e:
-            print(f"Something else failed: {e}")
-            exit(1)
         unique_file = ""
-        if len(cwfind.splitlines()) == 0:
+        if len(hash_paths[hs]) == 0:
             print("No files found for this hash")
             exit(1)
-        for line in cwfind.splitlines():
+        for line in hash_paths[hs]:
             if gta_translation is not None:
-                try:
-                    file_path = gta_translation[Path(line)]
-                except:
-                    if Path(line) not in ignored:
+                file_path, ignored = gta_translation(line)
+                if file_path is None:
+                    if not ignored:
                         print(f"Error finding trace associated to {line}")
                     continue
             else:
@@ -363,11 +618,10 @@ if __name__ == '__main__':
     args = parse_args()
 
     if args.translation is not None:
-        gta_translation, ignored = get_gta_translation(args.translation)
+        gta_translation = get_gta_translation(args.translation)
     else:
         gta_translation = None
-        ignored = None
 
-    labels, unique_file_paths, duplicates = prepare_vars(args.cwdb_path, gta_translation, ignored)
+    labels, unique_file_paths, duplicates = prepare_vars(args.cwdb_path, gta_translation)
     label_dist, result_list, gt_list = get_label_dist(labels, unique_file_paths, duplicates)
     print(analyze_clustering_performance(label_dist, len(labels), result_list, gt_list, True))
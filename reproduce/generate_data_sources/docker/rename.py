@@ -15,13 +15,201 @@
 
 """Rename input files so that no information can be gathered from filenames"""
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import fcntl
+import os
 import shutil
 import pickle
+import sqlite3
 import argparse
 
+# Number of translations that are written to the translation store at once
+TRANSLATION_BATCH_SIZE = 10000
 
-def rename_general(rename_inputs: bool):
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# ioctl request to reflink a file on Linux
+FICLONE = 0x40049409
+
+
+def is_sqlite_translation(translation_path: Path) -> bool:
+    """Check whether a translation is stored in SQLite or as pickled dictionary."""
+    with open(translation_path, "rb") as t:
+        return t.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def remove_translation(translation_path: Path):
+    """Remove a translation store including its write-ahead log."""
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{translation_path}{suffix}").unlink(missing_ok=True)
+
+
+def convert_pickled_translation(translation_path: Path):
+    """Replace a pickled translation of an earlier run by a SQLite store."""
+    print(f"Converting pickled translation {translation_path} to SQLite")
+    with open(translation_path, "rb") as t:
+        translation = pickle.load(t)
+
+    # The pickled translation is only replaced once the conversion is complete
+    converted_path = Path(f"{translation_path}.converted")
+    conn = open_translation(converted_path, create=True)
+    write_translation(conn, list(translation.items()))
+    conn.close()
+    os.replace(converted_path, translation_path)
+
+
+def open_translation(translation_path: Path, create: bool = False):
+    """Open the store that translates original input paths to generic ones."""
+    if create:
+        remove_translation(translation_path)
+    elif translation_path.is_file() and not is_sqlite_translation(translation_path):
+        convert_pickled_translation(translation_path)
+
+    conn = sqlite3.connect(translation_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS translation "
+        "(original TEXT PRIMARY KEY, generic TEXT NOT NULL)"
+    )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS translation_generic "
+        "ON translation (generic)"
+    )
+    return conn
+
+
+def write_translation(conn, batch: list[tuple[Path, Path]]):
+    """Write a batch of translations to the translation store."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO translation (original, generic) VALUES (?, ?)",
+        [(str(f), str(goal)) for f, goal in batch],
+    )
+    conn.commit()
+    batch.clear()
+
+
+def read_translation(translation_path: Path):
+    """Iterate over all (original, generic) path pairs of the translation."""
+    if not is_sqlite_translation(translation_path):
+        # Translation of an earlier run stored as pickled dictionary
+        with open(translation_path, "rb") as t:
+            yield from pickle.load(t).items()
+        return
+
+    conn = open_translation(translation_path)
+    try:
+        for f, i in conn.execute("SELECT original, generic FROM translation"):
+            yield Path(f), Path(i)
+    finally:
+        conn.close()
+
+
+def transfer_input(f: Path, goal: Path, link: bool):
+    """Hardlink or reflink an input to its generic name, or copy it otherwise."""
+    # A left-over of an interrupted run would make linking fail
+    goal.unlink(missing_ok=True)
+
+    if link:
+        try:
+            os.link(f, goal)
+            return
+        except OSError:
+            pass
+
+        try:
+            with open(f, "rb") as src, open(goal, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(f, goal)
+
+
+def copy_inputs(
+    files,
+    clean_input_path: Path,
+    conn,
+    i: int = 0,
+    link: bool = False,
+    workers: int | None = None,
+) -> int:
+    """Copy inputs to generic names and record the translation in batches.
+
+    Inputs that are already part of the translation are skipped, so that an
+    interrupted run can be resumed. Each batch is only recorded after all of its
+    inputs have been transferred.
+    """
+    translated = {f for (f,) in conn.execute("SELECT original FROM translation")}
+
+    def flush(batch):
+        list(executor.map(lambda fg: transfer_input(*fg, link), batch))
+        write_translation(conn, batch)
+
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for f in files:
+            if not f.is_file() or str(f) in translated:
+                continue
+
+            goal = clean_input_path / f"input_{i}{f.suffix}"
+            batch.append((f, goal))
+            i += 1
+
+            if len(batch) >= TRANSLATION_BATCH_SIZE:
+                flush(batch)
+
+        flush(batch)
+
+    return i
+
+
+def index_clean_traces(clean_traces_path: Path):
+    """Index the files of a trace directory with a single scan.
+
+    Returns the set of all file names and the names of ASan logs by the generic
+    input name they belong to.
+    """
+    names = set()
+    asan_logs = defaultdict(list)
+    if not clean_traces_path.is_dir():
+        return names, asan_logs
+
+    with os.scandir(clean_traces_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            names.add(entry.name)
+            prefix, sep, _ = entry.name.rpartition("_asan.")
+            if sep:
+                asan_logs[prefix].append(entry.name)
+
+    return names, asan_logs
+
+
+def move_files(moves: list[tuple[Path, Path]], workers: int | None = None):
+    """Move files to their goals with a bounded pool of threads."""
+    for parent in {goal.parent for _, goal in moves}:
+        parent.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda move: shutil.move(*move), moves))
+
+
+def num_translated(conn) -> int:
+    """Get the number of inputs that are already part of the translation."""
+    return conn.execute("SELECT COUNT(*) FROM translation").fetchone()[0]
+
+
+def rename_general(
+    rename_inputs: bool,
+    link: bool = False,
+    workers: int | None = None,
+    resume: bool = False,
+):
     input_path = Path("/project/inputs")
     clean_input_path = Path("/project/clean_inputs")
     translation_path = Path("/project/translation")
@@ -32,49 +220,43 @@ def rename_general(rename_inputs: bool):
     if rename_inputs:
         files = input_path.glob("**/*")
         clean_input_path.mkdir(parents=True, exist_ok=True)
-        translation = {}
-
-        i = 0
-        for f in files:
-            if not f.is_file():
-                continue
 
-            goal = clean_input_path / f"input_{i}{f.suffix}"
-            shutil.copyfile(f, goal)
-            translation[f] = goal
-            i += 1
-
-        with open(translation_path, "wb") as t:
-            pickle.dump(translation, t)
+        conn = open_translation(translation_path, create=not resume)
+        copy_inputs(files, clean_input_path, conn, num_translated(conn), link, workers)
+        conn.close()
     else:
-        with open(translation_path, "rb") as t:
-            translation = pickle.load(t)
-
-        for f, i in translation.items():
+        names, asan_logs = index_clean_traces(clean_traces_path)
+        moves = []
+        for f, i in read_translation(translation_path):
             trace_filename = i.name
-            trace = clean_traces_path / f"{trace_filename}_trace"
+            trace = f"{trace_filename}_trace"
 
-            if not trace.is_file():
+            if trace not in names:
                 continue
 
             goal_filename = f.name
             goal_sci_name = f.parent.name
 
             goal = traces_path / goal_sci_name / goal_filename
-            (goal.parent).mkdir(parents=True, exist_ok=True)
-            shutil.move(trace, goal)
+            moves.append((clean_traces_path / trace, goal))
 
-            asan_log_list = list(clean_traces_path.glob(f"{trace_filename}_asan.*"))
+            asan_log_list = asan_logs.get(trace_filename, [])
             if not len(asan_log_list) == 1:
                 continue
             else:
-                asan_log = asan_log_list[0]
+                asan_log = clean_traces_path / asan_log_list[0]
                 goal = asan_path / goal_sci_name / goal_filename
-                (goal.parent).mkdir(parents=True, exist_ok=True)
-                shutil.move(asan_log, goal)
+                moves.append((asan_log, goal))
+
+        move_files(moves, workers)
 
 
-def rename_default(rename_inputs: bool):
+def rename_default(
+    rename_inputs: bool,
+    link: bool = False,
+    workers: int | None = None,
+    resume: bool = False,
+):
     input_path = Path("/project/inputs")
     non_crashing_input_path = Path("/project/non_crashing_inputs")
     clean_input_path = Path("/project/clean_inputs")
@@ -85,40 +267,32 @@ def rename_default(rename_inputs: bool):
 
     if rename_inputs:
         clean_input_path.mkdir(parents=True, exist_ok=True)
-        translation = {}
-
-        files = input_path.glob("**/*")
-        i = 0
-        for f in files:
-            if not f.is_file():
-                continue
-
-            goal = clean_input_path / f"input_{i}{f.suffix}"
-            shutil.copyfile(f, goal)
-            translation[f] = goal
-            i += 1
 
-        files = non_crashing_input_path.glob("**/*")
-        for f in files:
-            if not f.is_file():
-                continue
-
-            goal = clean_input_path / f"input_{i}{f.suffix}"
-            shutil.copyfile(f, goal)
-            translation[f] = goal
-            i += 1
-
-        with open(translation_path, "wb") as t:
-            pickle.dump(translation, t)
+        conn = open_translation(translation_path, create=not resume)
+        i = copy_inputs(
+            input_path.glob("**/*"),
+            clean_input_path,
+            conn,
+            num_translated(conn),
+            link,
+            workers,
+        )
+        copy_inputs(
+            non_crashing_input_path.glob("**/*"),
+            clean_input_path,
+            conn,
+            i,
+            link,
+            workers,
+        )
+        conn.close()
     else:
-        with open(translation_path, "rb") as t:
-            translation = pickle.load(t)
-
-        for f, i in translation.items():
+        names, _ = index_clean_traces(clean_traces_path)
+        moves = []
+        for f, i in read_translation(translation_path):
             trace_filename = i.name
-            trace = clean_traces_path / f"{trace_filename}"
 
-            if not trace.is_file():
+            if trace_filename not in names:
                 continue
 
             goal_filename = f.name
@@ -129,20 +303,36 @@ def rename_default(rename_inputs: bool):
             else:
                 goal = traces_path / goal_sci_name / goal_filename
 
-            (goal.parent).mkdir(parents=True, exist_ok=True)
-            shutil.move(trace, goal)
+            moves.append((clean_traces_path / trace_filename, goal))
+
+        move_files(moves, workers)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--rename_inputs", action="store_true")
     parser.add_argument("--default", action="store_true")
+    parser.add_argument(
+        "--link",
+        action="store_true",
+        help="hardlink or reflink inputs instead of copying them where the "
+        "filesystem supports it",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None, help="number of copying threads"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="keep the translation of an interrupted run and skip inputs that are "
+        "part of it",
+    )
     args = parser.parse_args()
 
     if args.default:
-        rename_default(args.rename_inputs)
+        rename_default(args.rename_inputs, args.link, args.workers, args.resume)
     else:
-        rename_general(args.rename_inputs)
+        rename_general(args.rename_inputs, args.link, args.workers, args.resume)
 
 if __name__ == "__main__":
     main()